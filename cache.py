@@ -0,0 +1,159 @@
+import os
+
+import numpy as np
+
+from harmony import ALGORITHM_VERSION, Template, search_templates, template_params
+
+# Content addressed on-disk cache of image analysis: the hue histogram, the
+# score curves of every template and the best (template, alpha), one .npz per
+# image under sha256(content + ALGORITHM_VERSION).
+# Entries are written to a temporary file and moved in place, so concurrent
+# workers only ever see whole files; the least recently used (by mtime, touched
+# on every hit) are evicted past max_bytes.
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "color-composer"
+)
+MAX_BYTES = 256 << 20
+EVICT_EVERY = 64  # puts between directory scans
+
+
+def _digest(update):
+    import hashlib  # with zipfile and tempfile, loaded on use (startup.py)
+
+    h = hashlib.sha256(b"color-composer %d\n" % ALGORITHM_VERSION)
+    update(h)
+    return h.hexdigest()
+
+
+def file_key(path, block=1 << 20):
+    # hash of the file's bytes, cheaper than decoding it
+    def update(h):
+        with open(path, "rb") as f:
+            while chunk := f.read(block):
+                h.update(chunk)
+
+    return _digest(update)
+
+
+def array_key(array):
+    array = np.ascontiguousarray(array)
+
+    def update(h):
+        h.update(f"{array.dtype.str} {array.shape}\n".encode())
+        h.update(memoryview(array).cast("B"))
+
+    return _digest(update)
+
+
+class AnalysisCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.puts = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".npz")
+
+    def get(self, key):
+        # -> dict of arrays, or None (missing, evicted meanwhile or unreadable)
+        import zipfile
+
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = {name: data[name] for name in data.files}
+            os.utime(path)  # most recently used
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        return entry
+
+    def put(self, key, **arrays):
+        import tempfile
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.puts % EVICT_EVERY == 0:
+            self.evict()
+        self.puts += 1
+
+    def entries(self):
+        # -> [(mtime, size, path)] of every entry, oldest first
+        out = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".npz"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                out.append((stat.st_mtime, stat.st_size, path))
+        return sorted(out)
+
+    def evict(self):
+        # past max_bytes, oldest first down to 90% so it does not run every put
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_caches = {}  # directory -> AnalysisCache, one per process
+
+
+def open_cache(directory=CACHE_DIR):
+    # shared instance, so puts between evictions are counted across files
+    cache = _caches.get(directory)
+    if cache is None:
+        cache = _caches[directory] = AnalysisCache(directory)
+    return cache
+
+
+def cached_analysis(cache, key, histogram):
+    # -> cache entry of key, histogram() (256 bins) runs only on a miss
+    # entry: histogram, curves (template, alpha), template (index), alpha, score
+    entry = cache.get(key) if cache is not None else None
+    if entry is not None:
+        return entry
+    hue_weights = histogram()
+    index, alpha, curves = search_templates(hue_weights)
+    entry = dict(
+        histogram=hue_weights,
+        curves=curves,
+        template=np.int64(index),
+        alpha=np.int64(alpha),
+        score=curves[index, alpha],
+    )
+    if cache is not None:
+        cache.put(key, **entry)
+    return entry
+
+
+def entry_template(entry) -> Template:
+    return Template(*template_params[int(entry["template"])], int(entry["alpha"]))
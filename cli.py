@@ -0,0 +1,377 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+import instrument
+from cache import (
+    CACHE_DIR,
+    cached_analysis,
+    entry_template,
+    file_key,
+    open_cache,
+)
+from harmony import (
+    Template,
+    batch_search_templates,
+    template_params,
+    template_params_dict,
+)
+
+# Headless batch harmonization:
+#   python -m harmony photos/ "scans/*.tif" -o out/ -j 8
+#   python -m harmony photos/ -o out/ --template L --alpha 40
+
+IMAGE_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".gif",
+    ".bmp",
+    ".tif",
+    ".tiff",
+    ".webp",
+    ".ppm",
+    ".pnm",
+    ".npy",
+}
+
+
+def collect_inputs(patterns):
+    # files, directories (not recursive) and globs, in a stable order
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = glob.glob(pattern)
+        paths += sorted(
+            path
+            for path in matches
+            if os.path.isfile(path)
+            and os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+        )
+    return list(dict.fromkeys(paths))
+
+
+def output_path(src, out_dir, ext=None):
+    root, src_ext = os.path.splitext(os.path.basename(src))
+    return os.path.join(out_dir, root + (ext or src_ext))
+
+
+def up_to_date(src, dst):
+    return os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src)
+
+
+def process(job):
+    # runs in a worker process, never raises
+    src, dst, options = job
+    template_name, alpha = options["template"], options["alpha"]
+    tile_pixels, profile = options["tile_pixels"], options["profile"]
+    from stream import (
+        FrameSource,
+        TileSource,
+        harmonize_clip,
+        harmonize_file,
+        is_animated,
+        tiled_histogram,
+    )
+
+    name = src if isinstance(src, str) else f"{src[0]} (+{len(src) - 1} frames)"
+    if profile:
+        instrument.enable(memory=profile == "memory")
+        instrument.reset()
+    start = time.perf_counter()
+    try:
+        template = None
+        params = template_params
+        if template_name is not None:
+            params = [template_params_dict[template_name]]
+            if alpha is not None:
+                template = Template(*params[0], alpha)
+        if not isinstance(src, str) or is_animated(src):
+            # a list of frame files or an animated file
+            source = FrameSource(src)
+            width, height = source.size
+            frames = len(source)
+            templates = harmonize_clip(
+                source, dst, template, params, options["clip_mode"]
+            )
+            template = templates[0]
+        else:
+            source = TileSource(src)
+            width, height = source.size
+            frames = 1
+            if options["cache"] is not None and template_name is None:
+                # seen before: no analysis pass at all
+                entry = cached_analysis(
+                    open_cache(options["cache"]),
+                    file_key(src),
+                    lambda: tiled_histogram(source, tile_pixels),
+                )
+                template = entry_template(entry)
+            template = harmonize_file(
+                source, dst, template, tile_pixels, params, options["estimate"]
+            )
+        result = dict(
+            src=name,
+            dst=dst,
+            status="done",
+            seconds=time.perf_counter() - start,
+            megapixels=width * height * frames / 1e6,
+            template=template.name,
+            alpha=template.alpha,
+        )
+    except Exception as e:
+        result = dict(
+            src=name,
+            dst=dst,
+            status="failed",
+            seconds=time.perf_counter() - start,
+            error=f"{type(e).__name__}: {e}",
+        )
+    if profile:
+        result["stages"] = instrument.records()
+    return result
+
+
+def histogram_job(job):
+    # runs in a worker process, never raises: (src, histogram or None, error)
+    src, tile_pixels, cache_dir = job
+    from stream import (
+        FrameSource,
+        TileSource,
+        clip_histogram,
+        is_animated,
+        tiled_histogram,
+    )
+
+    try:
+        if is_animated(src):
+            # what harmonizing picks (--clip-mode clip), not the first frame;
+            # not cached, entries are of still images
+            return src, clip_histogram(FrameSource(src)), None
+        if cache_dir is None:
+            return src, tiled_histogram(TileSource(src), tile_pixels), None
+        entry = cached_analysis(
+            open_cache(cache_dir),
+            file_key(src),
+            lambda: tiled_histogram(TileSource(src), tile_pixels),
+        )
+        return src, entry["histogram"], None
+    except Exception as e:
+        return src, None, f"{type(e).__name__}: {e}"
+
+
+def run_jobs(fn, jobs, workers):
+    # results in job order, from a process pool when there is more than one
+    if workers <= 1 or len(jobs) <= 1:
+        yield from map(fn, jobs)
+        return
+    # imported here, multiprocessing is most of the startup time
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+        yield from pool.map(fn, jobs)
+
+
+def analyze(sources, args):
+    # best template of every image without writing any: histograms in the
+    # workers, then one batched search over all of them
+    start = time.perf_counter()
+    names, hists = [], []
+    failed = 0
+    jobs = [(src, args.tile_pixels, args.cache) for src in sources]
+    for src, hist, error in run_jobs(histogram_job, jobs, args.jobs):
+        if hist is None:
+            failed += 1
+            print(f"fail  {src}: {error}", file=sys.stderr)
+        else:
+            names.append(src)
+            hists.append(hist)
+    if hists:
+        hists = np.array(hists)
+        index, alpha, score = batch_search_templates(hists)
+        score /= np.maximum(hists.sum(axis=1), 1e-12)  # per unit weight
+        for src, i, a, sc in zip(names, index, alpha, score):
+            print(f"{src}  {template_params[i][0]} {a}  {sc:.3f}")
+    print(
+        f"{len(names)} analyzed, {failed} failed"
+        f" in {time.perf_counter() - start:.2f}s"
+    )
+    return 1 if failed else 0
+
+
+def report(results, collected=None):
+    # collected: list the results are also appended to
+    done = failed = 0
+    megapixels = 0.0
+    for r in results:
+        if collected is not None:
+            collected.append(r)
+        if r["status"] == "done":
+            done += 1
+            megapixels += r["megapixels"]
+            dst = (
+                r["dst"] if isinstance(r["dst"], str) else os.path.dirname(r["dst"][0])
+            )
+            print(
+                f"done  {r['src']} -> {dst}  {r['template']} {r['alpha']:g}"
+                f"  {r['megapixels']:.1f} MP  {r['seconds']:.2f}s"
+            )
+        else:
+            failed += 1
+            print(f"fail  {r['src']}: {r['error']}", file=sys.stderr)
+    return done, failed, megapixels
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m harmony", description="Batch color harmonization"
+    )
+    parser.add_argument("inputs", nargs="+", help="image files, directories or globs")
+    parser.add_argument("-o", "--output", help="output directory")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        choices=list(template_params_dict),
+        help="fixed template type (default: best one per image)",
+    )
+    parser.add_argument(
+        "-a",
+        "--alpha",
+        type=float,
+        help="fixed template rotation 0-255, may be fractional"
+        " (default: best one per image)",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="pick the template from a subsample, full scan only when ambiguous",
+    )
+    parser.add_argument(
+        "--clip-mode",
+        choices=["clip", "smooth"],
+        default="clip",
+        help="animations and sequences: one template for all frames, or per frame"
+        " templates from smoothed scores",
+    )
+    parser.add_argument(
+        "--sequence",
+        action="store_true",
+        help="the inputs are the frames of one clip, in name order",
+    )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="only print the best template of each image (template alpha score)",
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=CACHE_DIR,
+        help="reuse the analysis of images seen before (default dir: %(const)s)",
+    )
+    parser.add_argument("--ext", help="output extension, e.g. .png")
+    parser.add_argument(
+        "--tile-pixels", type=int, default=1 << 22, help="pixels per strip"
+    )
+    parser.add_argument("--profile", help="write per stage timings to this JSON file")
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="also trace peak memory per stage (slow)",
+    )
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="redo up to date outputs"
+    )
+    args = parser.parse_args(argv)
+    if args.output is None and not args.analyze:
+        parser.error("-o/--output is required")
+    if args.alpha is not None and args.template is None:
+        parser.error("--alpha needs --template")
+    if args.alpha is not None and not 0 <= args.alpha < 256:
+        parser.error("--alpha must be in 0-255")
+    if args.profile_memory and not args.profile:
+        parser.error("--profile-memory needs --profile")
+    if args.ext and not args.ext.startswith("."):
+        args.ext = "." + args.ext
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sources = collect_inputs(args.inputs)
+    if not sources:
+        print("No input images found", file=sys.stderr)
+        return 1
+    if args.analyze:
+        return analyze(sources, args)
+    os.makedirs(args.output, exist_ok=True)
+
+    profile = None
+    if args.profile:
+        profile = "memory" if args.profile_memory else "time"
+    options = dict(
+        template=args.template,
+        alpha=args.alpha,
+        tile_pixels=args.tile_pixels,
+        estimate=args.estimate,
+        clip_mode=args.clip_mode,
+        cache=args.cache,
+        profile=profile,
+    )
+    jobs = []
+    skipped = 0
+    if args.sequence:
+        # one job, frames keep their names
+        dsts = [output_path(src, args.output, args.ext) for src in sources]
+        if set(map(os.path.abspath, dsts)) & set(map(os.path.abspath, sources)):
+            print("Output would overwrite input frames", file=sys.stderr)
+            return 1
+        jobs.append((sources, dsts, options))
+        sources = []
+    for src in sources:
+        dst = output_path(src, args.output, args.ext)
+        if os.path.abspath(dst) == os.path.abspath(src):
+            print(f"skip  {src}: output would overwrite input", file=sys.stderr)
+            skipped += 1
+        elif not args.force and up_to_date(src, dst):
+            print(f"skip  {src}: up to date")
+            skipped += 1
+        else:
+            jobs.append((src, dst, options))
+
+    results = []
+    start = time.perf_counter()
+    done, failed, megapixels = report(run_jobs(process, jobs, args.jobs), results)
+    elapsed = time.perf_counter() - start
+
+    if args.profile:
+        # stage totals over all files, every record tagged with its file
+        stages = []
+        for r in results:
+            for record in r.pop("stages", []):
+                stages.append(dict(record, src=r["src"]))
+        instrument.dump(
+            args.profile, stages, seconds=elapsed, megapixels=megapixels, files=results
+        )
+
+    print(
+        f"{done} done, {skipped} skipped, {failed} failed"
+        f" | {megapixels:.1f} MP in {elapsed:.2f}s"
+        f" ({megapixels / elapsed if elapsed > 0 else 0:.2f} MP/s)"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,10 @@
+import math
 import numpy as np
-from scipy.optimize import minimize_scalar
-from scipy.stats import norm
 
-from numpy import pi, radians
+from numpy import pi
 from numbers import Number
-from tqdm import tqdm
-from itertools import product
+
+from instrument import timed
 
 
 def rad_distance(h1, h2):  # in radians
@@ -30,8 +29,11 @@ class Sector:
     ed: np.int32
 
     def __init__(self, start, size):
-        self.st = np.int32(start % 256)  # %256
-        self.ed = np.int32((start + size - 1) % 256)
+        # fractional starts (sub-bin alpha) stay float
+        whole = float(start).is_integer()
+        st, ed = start % 256, (start + size - 1) % 256
+        self.st = np.int32(st) if whole else st
+        self.ed = np.int32(ed) if whole else ed
         self.width = size
         self.center = (self.st + size // 2) % 256
         if self.st < self.ed:
@@ -58,6 +60,30 @@ class Sector:
         )
 
 
+def sector_distances(start, size, bins=256):
+    # vectorized Sector.distance for every hue bin, start/size in 0-255 units
+    scale = bins / 256
+    h = np.arange(bins)
+    offset = (h - start * scale) % bins  # walk from st
+    back = ((start + size - 1) * scale - h) % bins  # walk back from ed
+    dists = np.minimum(
+        np.minimum(offset, bins - offset),
+        np.minimum(back, bins - back),
+    )
+    dists[offset <= (size - 1) * scale] = 0
+    return dists
+
+
+def template_distances(sector_sizes, offsets, alpha, bins=256):
+    return np.min(
+        [
+            sector_distances(alpha + off, size, bins)
+            for off, size in zip(offsets, sector_sizes)
+        ],
+        axis=0,
+    )
+
+
 class Template:
     name: str
     sectors: list[Sector]
@@ -75,20 +101,14 @@ class Template:
         self.sectors = [
             Sector(alpha + off, size) for off, size in zip(offsets, sector_sizes)
         ]
-        self.dists = np.array([self._distance(h) for h in range(256)]).astype(np.int32)
+        self.dists = template_distances(sector_sizes, offsets, alpha)
+        if float(alpha).is_integer():
+            self.dists = self.dists.astype(np.int32)
 
         # debug
         if np.sum(self.dists) <= 0:
             raise ValueError(f"{self.name} {self.alpha} {self.sectors} dists <=0")
 
-    def _distance(self, h):  # may check in first for early return
-        min_dist = np.inf
-        for sector in self.sectors:
-            min_dist = min(min_dist, sector.distance(h))
-            if min_dist == 0:
-                return 0
-        return min_dist
-
 
 # Harmonic template types and sector widths (in 0-255)
 # 26% -> 66.56, 5% -> 12.8, 22% -> 56.32
@@ -103,6 +123,37 @@ template_params = [
 ]
 template_params_dict = {param[0]: param[:] for param in template_params}
 
+# bump when histograms or template search give different results (cache keys)
+ALGORITHM_VERSION = 1
+template_index = {param[0]: i for i, param in enumerate(template_params)}
+
+_distance_table = None
+
+
+def distance_table():
+    # (template, alpha, hue), built on first use
+    global _distance_table
+    if _distance_table is None:
+        _distance_table = np.stack(
+            [rotation_table(*param[1:]) for param in template_params]
+        )
+    return _distance_table
+
+
+def rotation_table(sector_sizes, offsets):
+    # rotating by alpha shifts the alpha=0 profile
+    base = template_distances(sector_sizes, offsets, 0).astype(np.uint8)
+    h = np.arange(256)
+    return base[(h[None, :] - h[:, None]) % 256]
+
+
+def param_table(param):
+    name = param[0]
+    if template_params_dict.get(name) == tuple(param):
+        return distance_table()[template_index[name]]
+    return rotation_table(*param[1:])
+
+
 # old problem: single color
 
 
@@ -119,78 +170,553 @@ def harmony_score(hue_weights, template):
     return s
 
 
-def minimize_alpha(hue_weights, param):
-    min_alpha = None
-    min_score = np.inf
-    # TODO speed up
-    for alpha in range(256):
-        score = harmony_score(hue_weights, Template(*param, alpha))
-        if score < min_score:
-            min_score, min_alpha = score, alpha
-    return min_score, min_alpha
-
-
-def find_best_template(hues, saturations) -> Template:
-    hue_weights = np.zeros(256).astype(np.float32)  # don't care precision
-    for h, s in zip(hues, saturations / 256):
-        hue_weights[h] += s
-
-    best_param = None
-    best_alpha = None
-    min_score = np.inf
-    for param in template_params:
-        score, alpha = minimize_alpha(hue_weights, param)
-        # TODO wide sector panalty
-        # print(param[0], score, alpha)
-        if score < min_score:
-            min_score, best_param, best_alpha = score, param, alpha
-
-    return Template(*best_param, best_alpha)
-
+@timed("search")
+def score_curves(hue_weights, params=template_params, method=None):
+    # scores of every rotation for each template, alpha in units of the bins
+    # (bins,) -> (templates, bins), or (N, bins) stacks -> (N, templates, bins)
+    # 256 bins: exact lookup in distance_table, otherwise circular correlation
+    hue_weights = np.asarray(hue_weights, dtype=np.float64)
+    bins = hue_weights.shape[-1]
+    if method is None:
+        method = "table" if bins == 256 else "fft"
+    if method == "table":
+        if bins != 256:
+            raise ValueError("Table scoring needs 256 bins")
+        if hue_weights.ndim == 1:
+            return np.stack([param_table(param) @ hue_weights for param in params])
+        # one matrix product per template for the whole stack
+        tables = [param_table(param).T for param in params]
+        return np.stack([hue_weights @ table for table in tables], axis=-2)
+    if method != "fft":
+        raise ValueError(f"Unknown scoring method {method}")
+
+    # score[a] = sum_h w[h] * base[h - a]
+    base = np.stack([template_distances(*param[1:], 0, bins) for param in params])
+    spectrum = np.fft.rfft(hue_weights)[..., None, :]
+    curves = np.fft.irfft(
+        spectrum * np.conj(np.fft.rfft(base, axis=1)), n=bins, axis=-1
+    )
+    # fft rounding, keep exact fits at zero
+    tol = 1e-9 * np.maximum(hue_weights.sum(-1) * base.max(), 1)
+    curves[curves < np.asarray(tol)[..., None, None]] = 0
+    return curves
+
+
+def smooth_distances(sector_sizes, offsets, alpha, bins=256, samples=16):
+    # template_distances averaged across each bin's width, continuous in alpha
+    # (alpha in 0-255 units, the bin's weight is spread evenly over the bin)
+    shifts = ((np.arange(samples) + 0.5) / samples - 0.5) * (256 / bins)
+    alphas = alpha - shifts[:, None]  # broadcasts to (samples, bins)
+    return template_distances(sector_sizes, offsets, alphas, bins).mean(axis=0)
+
+
+def golden_section(f, lo, hi, tol):
+    # -> (x, f(x)) minimum of a unimodal f on [lo, hi], one evaluation per step
+    g = (math.sqrt(5) - 1) / 2
+    c, d = hi - g * (hi - lo), lo + g * (hi - lo)
+    fc, fd = f(c), f(d)
+    while hi - lo > tol:
+        if fc <= fd:
+            hi, d, fd = d, c, fc
+            c = hi - g * (hi - lo)
+            fc = f(c)
+        else:
+            lo, c, fc = c, d, fd
+            d = lo + g * (hi - lo)
+            fd = f(d)
+    return (c, fc) if fc <= fd else (d, fd)
+
+
+@timed("refine")
+def refine_alpha(hue_weights, param, alpha, tol=1 / 64):
+    # -> (score, alpha) sub-bin rotation near a coarse alpha (0-255 units)
+    # golden section on the smoothed score within one bin either side
+    hue_weights = np.asarray(hue_weights, dtype=np.float64)
+    bins = len(hue_weights)
+    span = 256 / bins
+
+    def score(a):
+        return smooth_distances(*param[1:], a, bins) @ hue_weights
+
+    best = (alpha, score(alpha))
+    refined = golden_section(score, alpha - span, alpha + span, tol)
+    alpha, value = min(best, refined, key=lambda r: r[1])
+    return value, alpha % 256
+
+
+def minimize_alpha(hue_weights, param, refine=False):
+    # refine: fractional alpha (0-255 units) from a few more evaluations
+    scores = score_curves(hue_weights, [param])[0]
+    min_alpha = int(np.argmin(scores))
+    if refine:
+        bins = len(hue_weights)
+        return refine_alpha(hue_weights, param, min_alpha * 256 / bins)
+    return scores[min_alpha], min_alpha
+
+
+def search_templates(hue_weights, params=template_params, method=None):
+    # -> (index into params, alpha in bins, score curves)
+    curves = score_curves(hue_weights, params, method)
+    best_index, best_alpha = np.unravel_index(np.argmin(curves), curves.shape)
+    return int(best_index), int(best_alpha), curves
+
+
+def batch_search_templates(
+    hue_weights, params=template_params, method=None, chunk=4096
+):
+    # (N, bins) histograms -> (index into params, alpha in bins, score), each (N,)
+    # chunks of images bound the (chunk, templates, bins) score curves
+    hue_weights = np.atleast_2d(hue_weights)
+    n, bins = hue_weights.shape
+    index = np.empty(n, np.intp)
+    alpha = np.empty(n, np.intp)
+    score = np.empty(n)
+    for i in range(0, n, chunk):
+        curves = score_curves(hue_weights[i : i + chunk], params, method)
+        flat = curves.reshape(len(curves), -1)
+        best = np.argmin(flat, axis=1)
+        index[i : i + chunk], alpha[i : i + chunk] = np.divmod(best, bins)
+        score[i : i + chunk] = flat[np.arange(len(flat)), best]
+    return index, alpha, score
+
+
+def bin_alpha(alpha, bins):
+    # search bin -> rotation in 0-255 hue units, fractional unless bins == 256
+    alpha = float(alpha) * 256 / bins % 256
+    return int(alpha) if alpha.is_integer() else alpha
+
+
+def histogram_templates(hue_weights, params=template_params) -> list[Template]:
+    # histogram_template for every row of an (N, bins) stack
+    bins = np.shape(hue_weights)[-1]
+    index, alpha, _ = batch_search_templates(hue_weights, params)
+    return [Template(*params[i], bin_alpha(a, bins)) for i, a in zip(index, alpha)]
+
+
+def _row_chunks(a, chunk):
+    # views of ~chunk pixels along the first axis, avoids ravel copies of crops
+    a = np.asarray(a)
+    if a.ndim < 2:
+        for i in range(0, a.size, chunk):
+            yield a[i : i + chunk]
+        return
+    step = max(1, chunk // max(1, a[0].size))
+    for i in range(0, len(a), step):
+        yield a[i : i + step].reshape(-1)
+
+
+@timed("histogram")
+def hue_histogram(
+    hues,
+    saturations=None,
+    weights=None,
+    mask=None,
+    bins=256,
+    chunk=1 << 20,
+    power=1,
+):
+    # saturation weighted hue histogram, planes of any (matching) shape
+    # power=2 sums squared saturation weights (for sampling variance)
+    hues = np.asarray(hues)
+    if mask is not None:
+        mask = np.asarray(mask) != 0  # 0/1 image masks, not indices
+    planes = [hues]
+    for extra in (saturations, weights, mask):
+        if extra is not None:
+            planes.append(np.broadcast_to(extra, hues.shape))
+    # uint8 fast path: count (hue, saturation) pairs, weight the 256 levels after
+    joint = (
+        hues.dtype == np.uint8
+        and (saturations is None or planes[1].dtype == np.uint8)
+        and weights is None
+    )
+    size = 256 if joint else bins
+    hist = np.zeros(size * 256 if joint else size)
+
+    for chunks in zip(*(_row_chunks(p, chunk) for p in planes)):
+        h, rest = chunks[0], list(chunks[1:])
+        m = rest.pop() if mask is not None else None
+        s = rest.pop(0) if saturations is not None else None
+        w = rest.pop(0) if weights is not None else None
+        if m is not None:
+            h = h[m]
+            s = s[m] if s is not None else None
+            w = w[m] if w is not None else None
+
+        if joint:
+            idx = h.astype(np.uint16) << 8
+            if s is not None:
+                idx |= s
+            hist += np.bincount(idx, minlength=hist.size)
+            continue
 
+        idx = (h * (bins / 256)).astype(np.intp) % bins
+        if s is not None:
+            w = (s / 256) ** power if w is None else w * (s / 256) ** power
+        hist += np.bincount(idx, weights=w, minlength=bins)
+
+    if not joint:
+        return hist
+    if saturations is None:
+        hist = hist.reshape(256, 256)[:, 0]
+    else:
+        hist = hist.reshape(256, 256) @ (np.arange(256) / 256) ** power
+    if bins == 256:
+        return hist
+    rebinned = np.zeros(bins)
+    np.add.at(rebinned, (np.arange(256) * (bins / 256)).astype(np.intp), hist)
+    return rebinned
+
+
+def find_best_template(
+    hues, saturations, bins=256, weights=None, mask=None
+) -> Template:
+    hue_weights = hue_histogram(hues, saturations, weights, mask, bins)
+    return histogram_template(hue_weights)
+
+
+class IntegralHistogram:
+    # summed-area table of per cell hue histograms (saturation weighted like
+    # hue_histogram): the histogram of any rectangle in O(bins), whatever its
+    # area. Cells are cell x cell pixels, sized to keep under max_cells, and
+    # rectangles snap to the nearest cell edges (the image edges included, the
+    # last cells may be partial).
+    def __init__(self, hues, saturations=None, bins=256, max_cells=1 << 13):
+        height, width = np.shape(hues)[:2]
+        self.bins = bins
+        self.size = (width, height)
+        self.cell = max(1, math.ceil(math.sqrt(height * width / max_cells)))
+        self.grid = (-(-height // self.cell), -(-width // self.cell))
+        self.cells = np.zeros(self.grid + (bins,), np.float32)
+        self.table = None
+        self.update(hues, saturations)
+
+    @timed("integral")
+    def update(self, hues, saturations=None, rect=None):
+        # recount the cells touching rect (x, y, w, h), every cell by default
+        c, bins = self.cell, self.bins
+        gh, gw = self.grid
+        if rect is None:
+            cx0 = cy0 = 0
+            cx1, cy1 = gw, gh
+        else:
+            x, y, w, h = rect
+            cx0, cy0 = x // c, y // c
+            cx1, cy1 = min(gw, -(-(x + w) // c)), min(gh, -(-(y + h) // c))
+        if cx1 <= cx0 or cy1 <= cy0:
+            return
+        # one bincount per row of cells, index = local cell column * bins + bin
+        cols = (np.arange((cx1 - cx0) * c) // c * bins)[None, :]
+        for cy in range(cy0, cy1):
+            rows = slice(cy * c, (cy + 1) * c)
+            h = np.asarray(hues[rows, cx0 * c : cx1 * c])
+            idx = cols[:, : h.shape[1]] + (h.astype(np.intp) * bins >> 8)
+            weights = None
+            if saturations is not None:
+                weights = saturations[rows, cx0 * c : cx1 * c] / 256
+                weights = weights.ravel()
+            counts = np.bincount(idx.ravel(), weights, minlength=(cx1 - cx0) * bins)
+            self.cells[cy, cx0:cx1] = counts.reshape(cx1 - cx0, bins)
+        # float64 sums, large totals minus large totals
+        table = np.zeros((gh + 1, gw + 1, bins))
+        np.cumsum(self.cells, axis=0, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        self.table = table
+
+    def query(self, rect):
+        # -> hue histogram (float64, bins) of the rectangle (x, y, w, h)
+        x, y, w, h = rect
+        gh, gw = self.grid
+        width, height = self.size
+        c = self.cell
+        cx0, cy0 = min(gw - 1, round(x / c)), min(gh - 1, round(y / c))
+        cx1 = min(gw, max(cx0 + 1, round((x + w) / c)))
+        cy1 = min(gh, max(cy0 + 1, round((y + h) / c)))
+        if x + w >= width:
+            cx1 = gw
+        if y + h >= height:
+            cy1 = gh
+        t = self.table
+        hist = t[cy1, cx1] - t[cy0, cx1] - t[cy1, cx0] + t[cy0, cx0]
+        return np.maximum(hist, 0)
+
+
+def stratified_sample(plane, step):
+    # one pixel per step x step cell (its centre), a view for 2D planes
+    plane = np.asarray(plane)
+    off = step // 2
+    if plane.ndim >= 2:
+        return plane[off::step, off::step]
+    return plane[off * step :: step * step]
+
+
+def template_gap(hue_weights, hue_weights2, count):
+    # -> (template index, alpha, gap, z) for 256 bin histograms of count pixels
+    # gap: score difference to the closest other template, per unit weight
+    # z: that difference in standard errors of the sample mean
+    curves = score_curves(hue_weights)
+    alphas = np.argmin(curves, axis=1)
+    mins = curves[np.arange(len(curves)), alphas]
+    best = int(np.argmin(mins))
+    table = distance_table()
+    best_dists = table[best, alphas[best]].astype(np.float64)
+
+    gap = z = np.inf
+    total = max(hue_weights.sum(), 1e-12)
+    for t in range(len(curves)):
+        if t == best:
+            continue
+        diff = table[t, alphas[t]] - best_dists  # per pixel gain of best
+        mean = (mins[t] - mins[best]) / count
+        var = max(hue_weights2 @ diff**2 / count - mean**2, 0)
+        se = np.sqrt(var / count)
+        gap = min(gap, (mins[t] - mins[best]) / total)
+        z = min(z, mean / se if se > 0 else (np.inf if mean > 0 else 0.0))
+    return best, int(alphas[best]), gap, z
+
+
+def estimate_template(hues, saturations, step=8, min_z=3.0, refine=False):
+    # -> (Template, gap, z) from a stratified subsample of 2D H/S planes
+    # halves the step (4x the samples) until the pick is min_z standard errors
+    # clear of every other template, or the full image was used
+    while True:
+        h = stratified_sample(hues, step)
+        s = stratified_sample(saturations, step)
+        hue_weights = hue_histogram(h, s)
+        hue_weights2 = hue_histogram(h, s, power=2)
+        best, alpha, gap, z = template_gap(hue_weights, hue_weights2, max(h.size, 1))
+        if z >= min_z or step <= 1:
+            break
+        step //= 2
+    if refine:
+        _, alpha = refine_alpha(hue_weights, template_params[best], alpha)
+    return Template(*template_params[best], alpha), gap, z
+
+
+def histogram_template(hue_weights, params=template_params, refine=False) -> Template:
+    # best template for an already accumulated histogram
+    # refine: fractional alpha around the best rotation of the best template
+    bins = len(hue_weights)
+    # TODO wide sector panalty
+    best_index, best_alpha, _ = search_templates(hue_weights, params)
+
+    if refine:
+        param = params[best_index]
+        _, alpha = refine_alpha(hue_weights, param, best_alpha * 256 / bins)
+        return Template(*param, alpha)
+    return Template(*params[best_index], bin_alpha(best_alpha, bins))
+
+
+def sector_table(template: Template):
+    # (sector, hue) distances
+    return np.stack(
+        [sector_distances(sector.st, sector.width) for sector in template.sectors]
+    )
+
+
+def partition_lut(template: Template):
+    # closest sector of each hue, ties go to the first sector
+    return np.argmin(sector_table(template), axis=0).astype(np.uint8)
+
+
+@timed("partition")
 def binary_partition(hues, template: Template):
-    # primitive
-    partition = []
-    min_max = 0
-    for h in hues:
-        min_dist = np.inf
-        closest_sector_index = None
-        for i, sector in enumerate(template.sectors):
-            dist = sector.distance(h)
-            if dist < min_dist:
-                min_dist = dist
-                closest_sector_index = i
-        min_max = max(min_max, min_dist)
-        partition.append(closest_sector_index)
-    # print(min_max)
-    return partition
-
-
+    # one gather, keeps the shape of hues
+    return partition_lut(template)[hues]
+
+
+def _block_sums(planes, width, block, rows):
+    # per block sums along a band of image rows, one bincount per plane
+    cols = np.arange(width) // block
+    idx = np.broadcast_to(cols, (rows, width)).ravel()
+    blocks = cols[-1] + 1
+    return [np.bincount(idx, np.ravel(q), minlength=blocks) for q in planes]
+
+
+def _min_cut(source_caps, sink_caps, right, down):
+    # -> bool grid, True on the sink side of a minimum s-t cut
+    # source_caps/sink_caps: (gh, gw) t-links, right/down: n-links to the
+    # right (gh, gw - 1) and lower (gh - 1, gw) neighbours, both directions
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import breadth_first_order, maximum_flow
+
+    gh, gw = source_caps.shape
+    n = gh * gw
+    source, sink = n, n + 1
+    node = np.arange(n).reshape(gh, gw)
+    tails = [np.full(n, source), node.ravel()]
+    heads = [node.ravel(), np.full(n, sink)]
+    caps = [source_caps.ravel(), sink_caps.ravel()]
+    for a, b, w in (
+        (node[:, :-1], node[:, 1:], right),
+        (node[:-1], node[1:], down),
+    ):
+        tails += [a.ravel(), b.ravel()]
+        heads += [b.ravel(), a.ravel()]
+        caps += [w.ravel(), w.ravel()]
+    tails, heads, caps = map(np.concatenate, (tails, heads, caps))
+
+    # integer capacities, the total flow stays inside int32
+    total = max(source_caps.sum(), sink_caps.sum(), caps.max(), 1e-12)
+    caps = np.minimum(np.round(caps * (2**30 / total)), 2**31 - 1).astype(np.int32)
+    keep = caps > 0
+    graph = csr_matrix((caps[keep], (tails[keep], heads[keep])), shape=(n + 2, n + 2))
+    result = maximum_flow(graph, source, sink)
+    flow = getattr(result, "flow", None)
+    if flow is None:  # scipy < 1.8
+        flow = result.residual
+    residual = (graph - flow).tocsr()
+    residual.data[residual.data < 0] = 0
+    residual.eliminate_zeros()
+    reached = breadth_first_order(residual, source, return_predecessors=False)
+    sink_side = np.ones(n + 2, bool)
+    sink_side[reached] = False
+    return sink_side[:n].reshape(gh, gw)
+
+
+@timed("partition")
+def coherent_partition(
+    hues,
+    template: Template,
+    saturations=None,
+    max_nodes=1 << 16,
+    smoothness=2.0,
+    sigma=16.0,
+):
+    # sector labels like binary_partition, but neighbouring regions of similar
+    # hue stay on one sector: Cohen-Or's graph cut, solved on a block grid
+    # of at most max_nodes blocks (needs scipy, imported on first use)
+    #   data term: mean saturation weighted distance of a block to each sector
+    #   smoothness: cost of a label change between blocks of equal hue, in
+    #   the same hue units, falling off with their hue difference over sigma
+    # Blocks next to a label change are relabelled per pixel, so boundaries
+    # follow the image instead of the block grid. Work is done in bands of
+    # block rows, memory is O(max_nodes + one band).
+    hues = np.asarray(hues)
+    lut = partition_lut(template)
+    if len(template.sectors) != 2 or hues.ndim != 2:
+        return lut[hues]
+    height, width = hues.shape
+    block = max(1, math.ceil(math.sqrt(height * width / max_nodes)))
+    gh, gw = -(-height // block), -(-width // block)
+
+    dists = sector_table(template).astype(np.float32)
+    angle = np.arange(256) * (2 * pi / 256)
+    cos, sin = np.cos(angle), np.sin(angle)
+    sums = np.zeros((5, gh, gw))  # cost 0, cost 1, cos, sin, pixels
+    for by in range(gh):
+        h = hues[by * block : (by + 1) * block]
+        s = 1.0
+        if saturations is not None:
+            s = saturations[by * block : (by + 1) * block] / 256
+        planes = [dists[0][h] * s, dists[1][h] * s, cos[h] * s, sin[h] * s]
+        planes.append(np.ones(h.shape))
+        sums[:, by] = _block_sums(planes, width, block, len(h))
+    cost = sums[:2] / sums[4]
+    block_hue = np.arctan2(sums[3], sums[2]) * (256 / (2 * pi))
+
+    def link(a, b):
+        d = np.abs(a - b) % 256
+        d = np.minimum(d, 256 - d)
+        return smoothness * np.exp(-((d / sigma) ** 2))
+
+    right = link(block_hue[:, :-1], block_hue[:, 1:])
+    down = link(block_hue[:-1], block_hue[1:])
+    labels = _min_cut(
+        np.maximum(cost[1] - cost[0], 0),  # paid when the block takes sector 1
+        np.maximum(cost[0] - cost[1], 0),
+        right,
+        down,
+    ).astype(np.uint8)
+
+    # 3x3 block neighbourhoods holding both labels are decided per pixel
+    padded = np.pad(labels, 1, mode="edge")
+    windows = [padded[y : y + gh, x : x + gw] for y in range(3) for x in range(3)]
+    mixed = np.max(windows, axis=0) != np.min(windows, axis=0)
+
+    out = np.empty(hues.shape, np.uint8)
+    cols = np.arange(width) // block
+    for by in range(gh):
+        rows = slice(by * block, (by + 1) * block)
+        edge = mixed[by][cols]
+        out[rows] = np.where(edge, lut[hues[rows]], labels[by][cols])
+    return out
+
+
+def partition_max_distance(hues, template: Template):
+    # largest hue distance to its assigned sector (the old min_max)
+    present = np.bincount(np.ravel(hues), minlength=256) > 0
+    return int(np.max(template.dists[present]))
+
+
+_erf = np.vectorize(math.erf, otypes=[np.float64])
+
+
+def normal_cdf(x):
+    # standard normal CDF without scipy, only used on small LUTs
+    return 0.5 * (1 + _erf(np.asarray(x) / math.sqrt(2)))
+
+
+def shift_lut(template: Template):
+    # (sector, hue) -> shifted hue, every sector at once
+    C = np.array([sector.center for sector in template.sectors])[:, None]
+    w = np.array([sector.width for sector in template.sectors])[:, None]
+    # signed ring distance C -> h, wraps across 0/255
+    d = (np.arange(256) - C) % 256
+    d = np.where(d > 128, d - 256, d)
+    G_sigma = normal_cdf(d / (w / 2))  # Gaussian function
+    new_hues = C + (w / 2) * G_sigma
+    return (new_hues.astype(int) % 256).astype(np.uint8)
+
+
+@timed("shift")
 def shift_color(hues, partition, template: Template):
-    shifted_hues = []
-
-    new_hues = np.empty((len(template.sectors), 256), dtype=int)
-    s_h_combinations = product(range(len(template.sectors)), range(256))
-    for s, h in s_h_combinations:
-        if s == 2:
-            continue
-        sector = template.sectors[s]
-        C = sector.center  # central hue of the sector
-        w = sector.width  # arc-width of the sector
-        d = ring_distance_sign(C, h)
-        G_sigma = norm.cdf(d / (w / 2))  # Gaussian function
-        new_hue = C + (w / 2) * G_sigma
-        new_hue = int(new_hue) % 256
-        new_hues[s, h] = new_hue
-
-    for h, s in zip(hues, partition):
-        # sector = template.sectors[s]
-        # C = sector.center  # central hue of the sector
-        # w = sector.width  # arc-width of the sector
-        # d = ring_distance_sign(C, h)
-        # G_sigma = norm.cdf(d / (w / 2))  # Gaussian function
-        ## print(d, w, G_sigma)
-        # new_hue = C + (w / 2) * (1 - G_sigma)
-        # new_hue = int(new_hue) % 256
-        shifted_hues.append(new_hues[s, h])
-    return np.array(shifted_hues)
+    # one gather, uint8 in the shape of hues
+    return shift_lut(template)[partition, hues]
+
+
+def hue_lut(template: Template):
+    # partition + shift fused: final hue of every input hue
+    h = np.arange(256)
+    return shift_lut(template)[partition_lut(template), h]
+
+
+@timed("harmonize")
+def harmonize(hsv_array, template: Template, out=None, chunk=1 << 20, partition=None):
+    # remap the hue channel of a uint8 (..., 3) HSV buffer, in place by default
+    # partition: None for the nearest sector of each hue (one fused LUT),
+    # "coherent" for coherent_partition, or precomputed sector labels
+    if hsv_array.dtype != np.uint8 or hsv_array.shape[-1] != 3:
+        raise ValueError("Expected a uint8 HSV array")
+    if isinstance(partition, str):
+        if partition != "coherent":
+            raise ValueError(f"Unknown partition {partition}")
+        partition = coherent_partition(hsv_array[..., 0], template, hsv_array[..., 1])
+    if out is None:
+        out = hsv_array
+    elif out is not hsv_array:
+        out[..., 1:] = hsv_array[..., 1:]
+
+    src, dst = hsv_array[..., 0], out[..., 0]
+    if partition is None:
+        lut = hue_lut(template)
+        remap = lambda i, j: lut[src[i:j]]
+    else:
+        shift = shift_lut(template)
+        remap = lambda i, j: shift[partition[i:j], src[i:j]]
+    if src.ndim < 2:
+        dst[...] = remap(None, None)
+        return out
+    # row blocks bound the temporary gather result
+    step = max(1, chunk // max(1, src[0].size))
+    for i in range(0, len(src), step):
+        dst[i : i + step] = remap(i, i + step)
+    return out
+
+
+if __name__ == "__main__":
+    # python -m harmony: batch command line
+    import sys
+    from cli import main
+
+    sys.exit(main())
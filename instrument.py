@@ -0,0 +1,174 @@
+import functools
+import threading
+import time
+from collections import deque
+
+# Per-stage timing and memory, off by default:
+#   instrument.enable(memory=True)
+#   ... run the pipeline ...
+#   instrument.summary()  # {stage: {count, seconds, peak_mb}}
+# Disabled, stage() returns a shared no-op context manager.
+# memory uses tracemalloc: Python/NumPy allocations, slow, not PIL/Qt buffers.
+
+MAX_RECORDS = 1 << 16  # oldest records are dropped past this
+
+_enabled = False
+_memory = False
+_records = deque(maxlen=MAX_RECORDS)
+_seq = 0
+_lock = threading.Lock()
+_local = threading.local()  # stack of open stages per thread
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if _memory:
+            import tracemalloc
+
+            current, peak = tracemalloc.get_traced_memory()
+            # the outer stage keeps its peak so far, this one starts from here
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.base = current
+        else:
+            self.base = None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        record = dict(name=self.name, seconds=seconds)
+        if self.base is not None:
+            import tracemalloc
+
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            record["peak_mb"] = (self.peak - self.base) / 2**20
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        _add(record)
+        return False
+
+
+def _add(record):
+    global _seq
+    with _lock:
+        record["seq"] = _seq
+        _seq += 1
+        _records.append(record)
+
+
+def stage(name):
+    # with stage("histogram"): ...
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    # decorator form of stage, disabled it costs one extra call
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def enable(memory=False):
+    global _enabled, _memory
+    _enabled = True
+    _memory = memory
+    if memory:
+        import tracemalloc  # loaded only when memory is traced
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def disable():
+    global _enabled, _memory
+    _enabled = False
+    if _memory:
+        import tracemalloc
+
+        tracemalloc.stop()
+    _memory = False
+
+
+def enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _records.clear()
+
+
+def mark():
+    # records(since=mark()) later: only what ran in between
+    return _seq
+
+
+def records(since=0):
+    with _lock:
+        return [dict(r) for r in _records if r["seq"] >= since]
+
+
+def summary(recs=None):
+    # {stage: {count, seconds, peak_mb}} in first seen order
+    # seconds is the total, peak_mb the largest of any call
+    out = {}
+    for r in records() if recs is None else recs:
+        s = out.setdefault(r["name"], dict(count=0, seconds=0.0))
+        s["count"] += 1
+        s["seconds"] += r["seconds"]
+        if "peak_mb" in r:
+            s["peak_mb"] = max(s.get("peak_mb", 0.0), r["peak_mb"])
+    return out
+
+
+def format_summary(stats):
+    parts = []
+    for name, s in stats.items():
+        text = f"{name} {s['seconds'] * 1000:.1f} ms"
+        if s["count"] > 1:
+            text += f" ({s['count']}x)"
+        if "peak_mb" in s:
+            text += f" {s['peak_mb']:.1f} MB"
+        parts.append(text)
+    return " | ".join(parts)
+
+
+def dump(path, recs=None, **extra):
+    import json
+
+    with open(path, "w") as f:
+        recs = records() if recs is None else recs
+        json.dump(dict(extra, summary=summary(recs), records=recs), f, indent=1)
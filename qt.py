@@ -14,8 +14,23 @@ from PyQt5.QtWidgets import (
     QRubberBand,
     QStyleOptionRubberBand,
     QMessageBox,
+    QProgressBar,
+    QStatusBar,
+)
+from PyQt5.QtCore import (
+    Qt,
+    QRect,
+    QRectF,
+    QPointF,
+    QLineF,
+    pyqtSignal,
+    QPoint,
+    QSize,
+    QObject,
+    QRunnable,
+    QThreadPool,
+    QTimer,
 )
-from PyQt5.QtCore import Qt, QRect, QRectF, QPointF, QLineF, pyqtSignal, QPoint, QSize
 from PyQt5.QtGui import (
     QColor,
     QPainter,
@@ -34,48 +49,134 @@ from PyQt5.QtGui import (
 import math
 import numpy as np
 from PIL import Image
-from PIL.ImageQt import toqpixmap
-from harmony import find_best_template, binary_partition, shift_color
+import instrument
+from cache import file_key, open_cache
+from harmony import (
+    IntegralHistogram,
+    estimate_template,
+    harmonize,
+    histogram_template,
+    refine_alpha,
+)
+from instrument import stage
 
 BG_COLOR = "#202020"
 HALLOW = "#707070"
+PREVIEW_PIXELS = 1 << 18  # live preview resolution budget
+PREVIEW_INTERVAL = 15  # ms, mouse moves in between are coalesced
+PYRAMID_MIN_SIDE = 64  # smallest pyramid level
 
 
-def pil_image_to_qpixmap(pil_image):
-    # Convert the PIL Image to a QImage
-    pil_image = pil_image.convert("RGB")
-    data = np.array(pil_image)
-    qimage = QImage(
-        data, data.shape[1], data.shape[0], data.strides[0], QImage.Format_RGB888
-    )
+def numpy_to_qimage(array):
+    # zero copy QImage over a contiguous (h, w, 3) uint8 RGB array
+    # the QImage does not own the memory, keep the array alive as long as it
+    if not array.flags.c_contiguous:
+        raise ValueError("Array must be C contiguous")
+    h, w = array.shape[:2]
+    qimage = QImage(array.data, w, h, array.strides[0], QImage.Format_RGB888)
+    qimage.ndarray = array  # ties the buffer to the wrapper
+    return qimage
 
-    # Convert the QImage to a QPixmap
-    qpixmap = QPixmap.fromImage(qimage)
 
-    return qpixmap
+def qimage_to_numpy(qimage):
+    # zero copy (h, w, 3) view of an RGB888 QImage, valid while qimage lives
+    if qimage.format() != QImage.Format_RGB888:
+        qimage = qimage.convertToFormat(QImage.Format_RGB888)
+    ptr = qimage.constBits()
+    ptr.setsize(qimage.sizeInBytes())
+    rows = np.frombuffer(ptr, np.uint8).reshape(qimage.height(), qimage.bytesPerLine())
+    array = rows[:, : qimage.width() * 3].reshape(qimage.height(), qimage.width(), 3)
+    return array, qimage
 
 
-def qpixmap_to_pil_image(qpixmap):
-    # Convert the QPixmap to a QImage
-    qimage = qpixmap.toImage()
+def pil_image_to_qpixmap(pil_image):
+    # Convert the PIL Image to a QImage
+    data = np.asarray(pil_image.convert("RGB"))
+    # Convert the QImage to a QPixmap, the only copy Qt makes
+    return QPixmap.fromImage(numpy_to_qimage(data))
 
-    # Convert the QImage to a PIL Image
-    width = qimage.width()
-    height = qimage.height()
-    bytes_per_line = qimage.bytesPerLine()
-    data = qimage.bits().asstring(height * bytes_per_line)
-    pil_image = Image.frombytes("RGB", (width, height), data)
 
-    return pil_image
+def qpixmap_to_pil_image(qpixmap):
+    # Convert the QPixmap to a QImage
+    array, _ = qimage_to_numpy(qpixmap.toImage())
+    # Convert the QImage to a PIL Image, copying the rows out of Qt's buffer
+    return Image.fromarray(np.ascontiguousarray(array), mode="RGB")
+
+
+def image_pyramid(pil_image, size):
+    # RGB levels, each half the previous, the first the smallest that still
+    # covers size (w, h); the full resolution image is only decoded at save
+    image = pil_image
+    if getattr(pil_image, "filename", ""):
+        image = Image.open(pil_image.filename)
+        image.draft("RGB", size)  # JPEG decodes at 1/2 to 1/8 scale, others in full
+    image = image.convert("RGB")
+    factor = min(image.width // size[0], image.height // size[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    levels = [image]
+    while min(image.size) >= 2 * PYRAMID_MIN_SIDE:
+        image = image.reduce(2)
+        levels.append(image)
+    return levels
+
+
+def scale_rect(rect, scale, shape):
+    # (x, y, w, h) times scale (sx, sy), inside shape and at least one pixel
+    x, y, w, h = rect
+    sx, sy = scale
+    x0 = min(round(x * sx), shape[1] - 1)
+    y0 = min(round(y * sy), shape[0] - 1)
+    x1 = min(max(round((x + w) * sx), x0 + 1), shape[1])
+    y1 = min(max(round((y + h) * sy), y0 + 1), shape[0])
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def apply_edits(hsv, edits, size):
+    # replay (rect or None, template) edits in place, rects are at the full
+    # resolution size (w, h), hsv any level of it
+    scale = (hsv.shape[1] / size[0], hsv.shape[0] / size[1])
+    for rect, template in edits:
+        if rect is None:
+            harmonize(hsv, template)
+        else:
+            x, y, w, h = scale_rect(rect, scale, hsv.shape)
+            harmonize(hsv[y : y + h, x : x + w], template)
+    return hsv
+
+
+def replay_edits(rgb, edits):
+    # edits at full resolution in place on rgb, only the pixels inside an
+    # edit round trip through HSV (the bounding box is converted)
+    h, w = rgb.shape[:2]
+    rects = [(0, 0, w, h) if rect is None else rect for rect, _ in edits]
+    x0 = min(x for x, _, _, _ in rects)
+    y0 = min(y for _, y, _, _ in rects)
+    x1 = max(x + rw for x, _, rw, _ in rects)
+    y1 = max(y + rh for _, y, _, rh in rects)
+    box = rgb[y0:y1, x0:x1]
+    with stage("convert"):
+        hsv = np.array(Image.fromarray(box, mode="RGB").convert("HSV"))
+    shifted = [
+        ((x - x0, y - y0, rw, rh), t) for (x, y, rw, rh), (_, t) in zip(rects, edits)
+    ]
+    apply_edits(hsv, shifted, (x1 - x0, y1 - y0))
+    with stage("convert"):
+        out = np.asarray(Image.fromarray(hsv, mode="HSV").convert("RGB"))
+    edited = np.zeros(hsv.shape[:2], bool)
+    for x, y, rw, rh in rects:
+        edited[y - y0 : y - y0 + rh, x - x0 : x - x0 + rw] = True
+    box[edited] = out[edited]
+    return rgb
 
 
 class Sector:
-    st: int
-    sz: int
+    st: float  # degrees
+    sz: float
 
     def __init__(self, size, start):
-        self.st = int(start / 256 * 360)
-        self.sz = int(size / 256 * 360)
+        self.st = start / 256 * 360
+        self.sz = size / 256 * 360
 
 
 class Template:
@@ -88,10 +189,17 @@ class Template:
 from harmony import template_params, template_params_dict
 from harmony import Template as Htemplate
 
-print(template_params_dict)
+templates = {param[0]: Template(param[1], param[2]) for param in template_params}
 
 
-templates = {param[0]: Template(param[1], param[2]) for param in template_params}
+# ColorCircle angle (degrees) <-> harmony alpha (0-255), opposite directions
+# both fractional, the wheel is not limited to whole alpha steps
+def angle_to_alpha(angle):
+    return (-angle / 360 * 256) % 256
+
+
+def alpha_to_angle(alpha):
+    return (-alpha / 256 * 360) % 360
 
 
 def draw_template(target, type: str, inner_radius: int, p: QPainter = None):
@@ -104,12 +212,14 @@ def draw_template(target, type: str, inner_radius: int, p: QPainter = None):
         p.drawPie(
             inner_square,
             int((-getattr(target, "angle", 0) + sector.st) * 16),  # TODO must angle
-            sector.sz * 16,
+            int(sector.sz * 16),
         )
 
 
 class ColorCircle(QWidget):
     currentColorChanged = pyqtSignal(QColor)
+    angleChanged = pyqtSignal(float)  # while dragging
+    templateCommitted = pyqtSignal()  # drag released or template type changed
     center: QPointF
 
     def __init__(
@@ -127,14 +237,15 @@ class ColorCircle(QWidget):
         # self.center = QPointF(self.width() / 2, self.height() / 2)
         self.center = self.rect().center()
         self.currentSector = None
+        self.ring = None
+        self.ring_key = None
 
         qsp = QSizePolicy(QSizePolicy.Preferred, QSizePolicy.Preferred)
         qsp.setHeightForWidth(True)
         self.setSizePolicy(qsp)
         self.setStyleSheet(f"QWidget {{ background-color: {BG_COLOR}; }}")
 
-    def paintEvent(self, ev: QPaintEvent) -> None:
-        p = QPainter(self)
+    def begin_paint(self, p: QPainter) -> None:
         p.setPen(Qt.transparent)  # no frame
         p.setViewport(
             self.margin,
@@ -143,6 +254,18 @@ class ColorCircle(QWidget):
             self.height() - 2 * self.margin,
         )
 
+    def ring_pixmap(self) -> QPixmap:
+        # the hue ring only changes with size and value, cache it
+        dpr = self.devicePixelRatioF()
+        key = (self.width(), self.height(), self.v, dpr)
+        if self.ring_key == key:
+            return self.ring
+        pixmap = QPixmap(int(self.width() * dpr), int(self.height() * dpr))
+        pixmap.setDevicePixelRatio(dpr)
+        pixmap.fill(Qt.transparent)
+        p = QPainter(pixmap)
+        self.begin_paint(p)
+
         inner_radius = self.radius - 30
 
         def draw_circle(color, radius):
@@ -170,8 +293,17 @@ class ColorCircle(QWidget):
             # p.setCompositionMode(QPainter.CompositionMode_SourceOver)
 
         draw_hue_circle()
+        p.end()
+        self.ring, self.ring_key = pixmap, key
+        return pixmap
+
+    def paintEvent(self, ev: QPaintEvent) -> None:
+        p = QPainter(self)
+        p.drawPixmap(0, 0, self.ring_pixmap())
+        # only the template overlay is drawn per frame
         if self.currentSector:
-            draw_template(self, self.currentSector, inner_radius, p)
+            self.begin_paint(p)
+            draw_template(self, self.currentSector, self.radius - 30, p)
 
     def resizeEvent(self, ev: QResizeEvent) -> None:
         size = min(self.width(), self.height()) - self.margin * 2
@@ -188,8 +320,8 @@ class ColorCircle(QWidget):
         # Convert theta from radians to degrees and normalize to [0, 360)
         # not sure why need negative
         self.angle = (math.degrees(theta) + 360) % 360
-        print(self.angle)
-        self.repaint()
+        self.update()  # coalesced with other pending paints
+        self.angleChanged.emit(self.angle)
 
     def mouseMoveEvent(self, ev: QMouseEvent) -> None:
         self.processMouseEvent(ev)
@@ -197,9 +329,13 @@ class ColorCircle(QWidget):
     def mousePressEvent(self, ev: QMouseEvent) -> None:
         self.processMouseEvent(ev)
 
+    def mouseReleaseEvent(self, ev: QMouseEvent) -> None:
+        self.templateCommitted.emit()
+
     def changeSector(self, sector):
         self.currentSector = sector
         self.update()
+        self.templateCommitted.emit()
 
 
 class CustomRubberBand(QRubberBand):
@@ -220,9 +356,15 @@ class CustomRubberBand(QRubberBand):
 
 
 class ImageLabel(QLabel):
+    selectionChanged = pyqtSignal(object)  # (x, y, w, h) in full resolution or None
+    resized = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setAlignment(Qt.AlignCenter)  # Set alignment to center
+        # the window decides the size, the pixmap is scaled into it
+        self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        self.image_size = None  # (w, h) at full resolution, the pixmap may be less
         self.rubberBand = QRubberBand(QRubberBand.Rectangle, self)
         self.origin = QPoint()
         self.selected = False
@@ -240,46 +382,163 @@ class ImageLabel(QLabel):
     def mouseMoveEvent(self, event):
         if not self.origin.isNull():
             self.rubberBand.setGeometry(QRect(self.origin, event.pos()).normalized())
+            if self.pixmap() is not None:
+                self.selectionChanged.emit(self.image_rect(self.rubberBand.geometry()))
+
+    def display_rect(self):
+        # where the image is drawn: fit in the label, centered, never enlarged
+        w, h = self.image_size
+        scale = min(self.width() / w, self.height() / h, 1)
+        dw, dh = max(1, round(w * scale)), max(1, round(h * scale))
+        return QRect((self.width() - dw) // 2, (self.height() - dh) // 2, dw, dh)
+
+    def image_rect(self, rect):
+        # label rect -> (x, y, w, h) at full resolution clipped to the image,
+        # None if empty
+        w, h = self.image_size
+        d = self.display_rect()
+        sx, sy = w / d.width(), h / d.height()
+        # aligned center
+        ox, oy = d.x(), d.y()
+        ex, ey = ox + d.width(), oy + d.height()
+        rx = rect.x()
+        ry = rect.y()
+        rex = rx + rect.width()
+        rey = ry + rect.height()
+        x = math.floor((min(max(rx, ox), ex) - ox) * sx)
+        y = math.floor((min(max(ry, oy), ey) - oy) * sy)
+        x1 = math.ceil((min(max(rex, ox), ex) - ox) * sx)
+        y1 = math.ceil((min(max(rey, oy), ey) - oy) * sy)
+        if x1 > x and y1 > y:
+            return x, y, min(x1, w) - x, min(y1, h) - y
+        return None
+
+    def paintEvent(self, event):
+        pixmap = self.pixmap()
+        if pixmap is None or pixmap.isNull() or self.image_size is None:
+            return super().paintEvent(event)
+        p = QPainter(self)
+        p.setRenderHint(QPainter.SmoothPixmapTransform)
+        p.drawPixmap(self.display_rect(), pixmap, pixmap.rect())
+        p.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.resized.emit()
 
     def mouseReleaseEvent(self, event):
         pixmap = self.pixmap()
         if self.rubberBand.isVisible() and pixmap is not None:
-            rect = self.rubberBand.geometry()
-            # aligned center
-            pw = pixmap.width()
-            ph = pixmap.height()
-            ox = self.width() / 2 - pw / 2
-            oy = self.height() / 2 - ph / 2
-            ex = ox + pw
-            ey = oy + ph
-            rx = rect.x()
-            ry = rect.y()
-            rex = rx + rect.width()
-            rey = ry + rect.height()
-            # print(f"Selection rectangle: {rect}")
-            self.subx = int(min(max(rx, ox), ex) - ox)
-            self.suby = int(min(max(ry, oy), ey) - oy)
-            self.subw = int(min(max(rex, ox), ex) - ox - self.subx)
-            self.subh = int(min(max(rey, oy), ey) - oy - self.suby)
-            if self.subw > 0 and self.subh > 0:
+            rect = self.image_rect(self.rubberBand.geometry())
+            if rect is not None:
+                self.subx, self.suby, self.subw, self.subh = rect
                 self.selected = True
             else:
                 self.selected = False
-            print(
-                f"Selection rectangle: {self.subx} {self.suby} {self.subw} {self.subh}"
-            )
+            self.selectionChanged.emit(rect)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class HarmonizeSignals(QObject):
+    progress = pyqtSignal(str, int)  # stage, percent
+    finished = pyqtSignal(object)  # (rect, hsv region, rgb region, template)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class HarmonizeJob(QRunnable):
+    # optimize_image off the GUI thread, only PIL/numpy here (no QPixmap)
+    # hsv is only read, the harmonized region comes back through finished
+    def __init__(self, hsv, rect=None, sector=None, alpha=0, preview=False, cache=None):
+        super().__init__()
+        self.hsv = hsv
+        self.cache = cache  # (AnalysisCache, file path) of an unedited whole image
+        self.level = 0  # pyramid level of hsv and the full resolution selection,
+        self.selection = None  # set by PhotoDisplayer to record the edit
+        self.preview = preview  # commit of a live preview
+        self.rect = rect  # (x, y, w, h) or None for the whole image
+        self.sector = sector  # None: find the best template
+        self.alpha = alpha
+        self.signals = HarmonizeSignals()
+        self._cancelled = False
+        self.mark = instrument.mark()  # its stages for the status bar
+
+    def cancel(self):
+        self._cancelled = True
+
+    def stage(self, name, percent):
+        if self._cancelled:
+            raise JobCancelled()
+        self.signals.progress.emit(name, percent)
+
+    def run(self):
+        try:
+            # only the subimage
+            if self.rect is None:
+                self.rect = (0, 0, self.hsv.shape[1], self.hsv.shape[0])
+            x, y, w, h = self.rect
+            sub_hsv = self.hsv[y : y + h, x : x + w]
+
+            # Find the best harmonic template
+            self.stage("Searching template", 0)
+            entry = None
+            if self.sector is None and self.cache is not None:
+                # full resolution analysis of a file seen before (e.g. by the
+                # batch command), a miss is not written back from a reduced level
+                cache, path = self.cache
+                entry = cache.get(file_key(path))  # hashed here, off the GUI thread
+            if entry is not None:
+                param = template_params[int(entry["template"])]
+                _, alpha = refine_alpha(entry["histogram"], param, entry["alpha"])
+                template = Htemplate(*param, alpha)
+            elif self.sector is None:
+                # subsampled histogram, rescans more pixels only when ambiguous
+                template, _, _ = estimate_template(
+                    sub_hsv[..., 0], sub_hsv[..., 1], refine=True
+                )
+            else:
+                template = Htemplate(*template_params_dict[self.sector], self.alpha)
+
+            self.stage("Harmonizing", 30)
+            region = harmonize(sub_hsv, template, out=np.empty_like(sub_hsv))
+
+            # only the edited region goes back to RGB
+            self.stage("Converting", 60)
+            with stage("convert"):
+                rgb = np.asarray(Image.fromarray(region, mode="HSV").convert("RGB"))
+            self.stage("Displaying", 90)
+            self.signals.finished.emit((self.rect, region, rgb, template))
+        except JobCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.failed.emit(f"{type(e).__name__}: {e}")
 
 
 class PhotoDisplayer(QWidget):
+    profiled = pyqtSignal(str)  # stage timings of the last operation
+
     def __init__(self, colorCircle: ColorCircle, parent=None):
         super().__init__(parent)
         self.colorCircle = colorCircle
-        self.pil_image = None
+        self.source = None  # full resolution PIL image, decoded at save
+        self.levels = []  # RGB pyramid of source, largest first
+        self.level = None  # the one shown, matching the label size
+        self.edits = []  # (full resolution rect or None, template), replayed at save
+        self.rgb = None  # RGB of the shown level, follows hsv
+        self.qimage = None  # zero copy view of rgb
+        self.pixmap = None  # what the label shows, updated by dirty rect
+        self.hsv = None  # shown level with the edits applied
+        self.cache = open_cache()  # analysis of files opened before
+        self.cache_path = None
 
         self.layout = QVBoxLayout(self)
 
         # Create a QLabel to display the image
         self.photo = ImageLabel()
+        self.photo.resized.connect(self.on_resized)
         self.layout.addWidget(self.photo)
 
         self.button_layout = QHBoxLayout()
@@ -309,10 +568,64 @@ class PhotoDisplayer(QWidget):
         self.save_button.clicked.connect(self.save_image)
         self.button_layout.addWidget(self.save_button)
 
+        # Live preview while the template is dragged on the color wheel
+        self.live_button = QPushButton("Live")
+        self.live_button.setStyleSheet(
+            f"background-color: {HALLOW}; font-weight: bold;"
+        )
+        self.live_button.setCheckable(True)
+        self.live_button.toggled.connect(self.toggle_live_preview)
+        self.button_layout.addWidget(self.live_button)
+
+        # Suggest a template for the selection while it is dragged
+        self.suggest_button = QPushButton("Suggest")
+        self.suggest_button.setStyleSheet(
+            f"background-color: {HALLOW}; font-weight: bold;"
+        )
+        self.suggest_button.setCheckable(True)
+        self.suggest_button.toggled.connect(self.toggle_suggest)
+        self.button_layout.addWidget(self.suggest_button)
+        self.integral = None  # IntegralHistogram of hsv while suggesting
+        self.photo.selectionChanged.connect(self.suggest_template)
+        self.photo.selectionChanged.connect(self.rebase_preview)
+
+        self.preview_base = None  # hsv snapshot the live preview harmonizes
+        self.preview_edits = 0  # edits in preview_base, a commit replaces the rest
+        self.proxy = None  # (key, hsv, geometry in label, step, origin)
+        self.preview_label = QLabel(self.photo)
+        self.preview_label.setScaledContents(True)
+        self.preview_label.hide()
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_INTERVAL)
+        self.preview_timer.timeout.connect(self.render_preview)
+        colorCircle.angleChanged.connect(self.schedule_preview)
+        colorCircle.templateCommitted.connect(self.commit_preview)
+
+        # Progress of the running optimize job
+        self.progress_layout = QHBoxLayout()
+        self.layout.addLayout(self.progress_layout)
+        self.progress = QProgressBar()
+        self.progress.setFormat("%p%")
+        self.progress.setTextVisible(True)
+        self.progress.hide()
+        self.progress_layout.addWidget(self.progress)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setStyleSheet(
+            f"background-color: {HALLOW}; font-weight: bold;"
+        )
+        self.cancel_button.clicked.connect(self.cancel_optimize)
+        self.cancel_button.hide()
+        self.progress_layout.addWidget(self.cancel_button)
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.job = None
+
         # self.rubberBand = QRubberBand(QRubberBand.Rectangle, self)
 
     def save_image(self):
-        if self.pil_image is None:
+        if self.source is None:
             self.warning("No image loaded")
             return
         options = QFileDialog.Options()
@@ -325,7 +638,15 @@ class PhotoDisplayer(QWidget):
             options=options,
         )
         if file_name:
-            self.pil_image.save(file_name)
+            mark = instrument.mark()
+            # the edits so far only touched the pyramid, now at full resolution
+            with stage("decode"):
+                rgb = np.array(self.source.convert("RGB"))
+            if self.edits:
+                replay_edits(rgb, self.edits)
+            with stage("save"):
+                Image.fromarray(rgb, mode="RGB").save(file_name)
+            self.report_profile("Save", mark)
 
     # def mousePressEvent(self, event):
     #    if event.button() == Qt.LeftButton:
@@ -356,95 +677,327 @@ class PhotoDisplayer(QWidget):
         if not file:
             return
         # Load and display the image
-        self.pil_image = Image.open(file)
+        self.set_image(Image.open(file), file)
+
+    def set_image(self, pil_image, path=None):
+        # a running job would overwrite the new image
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+            self.set_busy(False)
+        mark = instrument.mark()
+        self.cache_path = path  # the file, a cache key while unedited
+        self.source = pil_image
+        self.edits = []
+        self.photo.image_size = pil_image.size
+        # decoded only as large as the screen can show
+        screen = self.screen().availableGeometry()
+        ratio = self.devicePixelRatioF()
+        w, h = pil_image.size
+        scale = min(screen.width() * ratio / w, screen.height() * ratio / h, 1)
+        with stage("decode"):
+            self.levels = image_pyramid(
+                pil_image, (max(1, int(w * scale)), max(1, int(h * scale)))
+            )
+        self.preview_label.hide()
+        self.preview_edits = 0  # a live preview base is rebuilt by show_level
+        self.show_level(self.choose_level())
+        self.report_profile("Load", mark)
+
+    def choose_level(self):
+        # smallest level at least as large as the image is shown
+        rect = self.photo.display_rect()
+        ratio = self.photo.devicePixelRatioF()
+        for level in reversed(range(len(self.levels))):
+            image = self.levels[level]
+            if (
+                image.width >= rect.width() * ratio
+                and image.height >= rect.height() * ratio
+            ):
+                return level
+        return 0
+
+    def level_scale(self):
+        # full resolution -> shown level
+        w, h = self.source.size
+        return self.hsv.shape[1] / w, self.hsv.shape[0] / h
+
+    def level_hsv(self, level, edits):
+        with stage("convert"):
+            hsv = np.array(self.levels[level].convert("HSV"))
+        return apply_edits(hsv, edits, self.source.size)
+
+    def show_level(self, level):
+        # hsv and rgb of the level with the edits replayed, then displayed
+        self.level = level
+        self.hsv = self.level_hsv(level, self.edits)
+        with stage("convert"):
+            if self.edits:
+                self.rgb = np.array(
+                    Image.fromarray(self.hsv, mode="HSV").convert("RGB")
+                )
+            else:
+                self.rgb = np.array(self.levels[level])
         self.display_image()
+        if self.preview_base is not None:
+            count = self.preview_edits
+            self.set_preview_base(self.level_hsv(level, self.edits[:count]), count)
+        if self.suggest_button.isChecked():
+            self.integral = IntegralHistogram(self.hsv[..., 0], self.hsv[..., 1])
+
+    def on_resized(self):
+        if not self.levels:
+            return
+        level = self.choose_level()
+        if level != self.level:
+            mark = instrument.mark()
+            self.show_level(level)
+            self.report_profile("Resize", mark)
 
     def display_image(self):
-        pixmap = pil_image_to_qpixmap(self.pil_image)
-        # Display the QPixmap
-        self.photo.setPixmap(pixmap)
+        # full upload, after loading or a change of level
+        with stage("upload"):
+            self.qimage = numpy_to_qimage(self.rgb)
+            self.pixmap = QPixmap.fromImage(self.qimage)
+            # Display the QPixmap
+            self.photo.setPixmap(self.pixmap)
+
+    def update_display(self, rect):
+        # upload only the dirty rectangle of rgb into the shown pixmap
+        x, y, w, h = rect
+        with stage("upload"):
+            # the label shares the pixmap, painting on it would detach a full copy
+            self.photo.clear()
+            p = QPainter(self.pixmap)
+            p.drawImage(QPoint(x, y), self.qimage, QRect(x, y, w, h))
+            p.end()
+            self.photo.setPixmap(self.pixmap)
 
     def setColorWheel(self, t, angle):
         self.colorCircle.currentSector = t
         self.colorCircle.angle = angle
-        self.colorCircle.repaint()
+        self.colorCircle.update()
+
+    def report_profile(self, operation, mark):
+        if instrument.enabled():
+            stats = instrument.summary(instrument.records(mark))
+            self.profiled.emit(f"{operation}: {instrument.format_summary(stats)}")
 
     def warning(self, message):
         msg_box = QMessageBox(self)
         msg_box.setIcon(QMessageBox.Warning)
         msg_box.setWindowTitle("Warning")
         msg_box.setText("<b><FONT COLOR='#f0f0f0'>" + message + "</FONT></b>")
-        msg_box.setStyleSheet(
-            """
+        msg_box.setStyleSheet("""
         QPushButton {
             color: white;
             font-weight: bold;
             background-color: #505050;
         }
-    """
-        )
+    """)
         msg_box.exec_()
 
     def optimize_image(self):
-        # Convert the PIL Image to a NumPy array and convert to HSV
-        if self.pil_image is None:
+        if self.hsv is None:
             self.warning("No image loaded")
             return
-        hsv = np.array(self.pil_image.convert("HSV"))
-        # only crop the subimage
-        if self.photo.selected:
-            sub_hsv = hsv[
-                self.photo.suby : self.photo.suby + self.photo.subh,
-                self.photo.subx : self.photo.subx + self.photo.subw,
-            ]
-            arr_shape = sub_hsv.shape
-        else:
-            sub_hsv = hsv
-            arr_shape = hsv.shape
-        H, S, V = np.reshape(sub_hsv, (-1, 3)).T.astype(np.int32)
-
-        # Find the best harmonic template
-        if self.colorCircle.currentSector is None:
-            best_template = find_best_template(H, S)
-            print(f"Best harmonic template: {best_template.name} {best_template.alpha}")
-        else:
-            print(
-                *template_params_dict[self.colorCircle.currentSector],
-                int((-self.colorCircle.angle / 360 * 256) % 256),
-                self.colorCircle.angle,
-            )
-            best_template = Htemplate(
-                *template_params_dict[self.colorCircle.currentSector],
-                int((-self.colorCircle.angle / 360 * 256) % 256),
-            )
-
-        # Partition the hues and shift the colors
-        partition = binary_partition(H, best_template)
-        nH = shift_color(H, partition, best_template)
-
-        # Convert the harmonized hues back to HSV
-        new_hsv = np.reshape(
-            np.stack([nH, S, V]).T,
-            arr_shape,
-        )
+        if self.job is not None:
+            self.warning("Optimize is already running")
+            return
 
-        if self.photo.selected:
-            hsv[
-                self.photo.suby : self.photo.suby + self.photo.subh,
-                self.photo.subx : self.photo.subx + self.photo.subw,
-            ] = new_hsv
+        self.start_job(self.hsv)
+
+    def selection(self):
+        if not self.photo.selected:
+            return None
+        return (self.photo.subx, self.photo.suby, self.photo.subw, self.photo.subh)
+
+    def start_job(self, hsv, preview=False):
+        sector = self.colorCircle.currentSector
+        alpha = angle_to_alpha(self.colorCircle.angle)
+        selection = self.selection()
+        rect = None
+        if selection is not None:
+            rect = scale_rect(selection, self.level_scale(), hsv.shape)
+        cache = None
+        if rect is None and not self.edits and self.cache_path is not None:
+            cache = (self.cache, self.cache_path)
+        self.job = HarmonizeJob(hsv, rect, sector, alpha, preview, cache)
+        self.job.level, self.job.selection = self.level, selection
+        self.job.signals.progress.connect(self.on_optimize_progress)
+        self.job.signals.finished.connect(self.on_optimize_finished)
+        self.job.signals.failed.connect(self.on_optimize_failed)
+        self.job.signals.cancelled.connect(self.on_optimize_cancelled)
+        self.set_busy(True)
+        self.pool.start(self.job)
+
+    def cancel_optimize(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.progress.setFormat("Cancelling...")
+
+    def set_busy(self, busy):
+        self.optimize_button.setEnabled(not busy)
+        self.progress.setValue(0)
+        self.progress.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+
+    def end_job(self):
+        # results of a job that was replaced (e.g. by loading a file) are dropped
+        job = self.sender()
+        if self.job is None or job is not self.job.signals:
+            return False
+        self.job = None
+        self.set_busy(False)
+        return True
+
+    def on_optimize_progress(self, stage, percent):
+        if self.job is not None and self.sender() is self.job.signals:
+            self.progress.setFormat(f"{stage} %p%")
+            self.progress.setValue(percent)
+
+    def on_optimize_finished(self, result):
+        job = self.job
+        preview = job is not None and job.preview
+        if not self.end_job():
+            return
+        (x, y, w, h), region, rgb, best_template = result
+        if preview:
+            del self.edits[self.preview_edits :]  # replaces the last preview
+        self.edits.append((job.selection, best_template))
+        if job.level != self.level:
+            # done on another level, replayed on the shown one
+            self.show_level(self.level)
+        elif preview:
+            # on top of its base, not of the last preview
+            self.hsv[...] = self.preview_base
+            self.hsv[y : y + h, x : x + w] = region
+            with stage("convert"):
+                self.rgb = np.array(
+                    Image.fromarray(self.hsv, mode="HSV").convert("RGB")
+                )
+            self.display_image()
+            if self.integral is not None:
+                self.integral.update(self.hsv[..., 0], self.hsv[..., 1])
         else:
-            hsv = new_hsv
-        # Convert the harmonized image back to a PIL Image and display it
-        self.pil_image = Image.fromarray(hsv.astype(np.uint8), mode="HSV").convert(
-            "RGB"
-        )
-        qpixmap = pil_image_to_qpixmap(self.pil_image)
-        self.photo.setPixmap(qpixmap)
+            self.hsv[y : y + h, x : x + w] = region
+            self.rgb[y : y + h, x : x + w] = rgb
+            self.update_display((x, y, w, h))
+            if self.integral is not None:
+                self.integral.update(self.hsv[..., 0], self.hsv[..., 1], (x, y, w, h))
+        self.preview_label.hide()
+        self.report_profile("Optimize", job.mark)
+        if preview:
+            # keep the selection and base, the next drag re-renders from base
+            return
         self.photo.rubberBand.hide()
         self.photo.selected = False
-        print("done")
-        self.setColorWheel(best_template.name, int(-best_template.alpha / 256 * 360))
+        if self.preview_base is not None:
+            self.set_preview_base(self.hsv.copy())
+        self.setColorWheel(best_template.name, alpha_to_angle(best_template.alpha))
+
+    def toggle_suggest(self, on):
+        self.integral = None
+        if on and self.hsv is not None:
+            self.integral = IntegralHistogram(self.hsv[..., 0], self.hsv[..., 1])
+
+    def suggest_template(self, rect):
+        # best template of the selection from the integral histogram, O(bins)
+        if self.integral is None or rect is None:
+            return
+        hue_weights = self.integral.query(
+            scale_rect(rect, self.level_scale(), self.hsv.shape)
+        )
+        if hue_weights.sum() <= 0:
+            return
+        template = histogram_template(hue_weights)
+        self.setColorWheel(template.name, alpha_to_angle(template.alpha))
+
+    def toggle_live_preview(self, live):
+        live = live and self.hsv is not None
+        self.set_preview_base(self.hsv.copy() if live else None)
+        if not live:
+            self.preview_timer.stop()
+            self.preview_label.hide()
+
+    def set_preview_base(self, hsv, edits=None):
+        # edits: how many of self.edits hsv has, all by default
+        self.preview_base = hsv
+        self.preview_edits = len(self.edits) if edits is None else edits
+        self.proxy = None
+
+    def rebase_preview(self, rect):
+        # a commit replaces the last preview of the same selection only, the
+        # previous selection's one stays and the next previews go on top of it
+        if (
+            self.preview_base is not None
+            and len(self.edits) > self.preview_edits
+            and self.edits[-1][0] != rect
+        ):
+            self.set_preview_base(self.hsv.copy())
+
+    def schedule_preview(self, angle):
+        # coalesce mouse moves, the timer renders the latest angle
+        if self.preview_base is None or self.colorCircle.currentSector is None:
+            return
+        if not self.preview_timer.isActive():
+            self.preview_timer.start()
+
+    def preview_proxy(self):
+        # preview_base (the shown level) reduced to PREVIEW_PIXELS
+        if self.proxy is None:
+            h, w = self.preview_base.shape[:2]
+            step = max(1, math.ceil(math.sqrt(h * w / PREVIEW_PIXELS)))
+            # strided, averaging would mix hues across the 0/255 wrap
+            self.proxy = (np.ascontiguousarray(self.preview_base[::step, ::step]), step)
+        return self.proxy
+
+    def render_preview(self):
+        sector = self.colorCircle.currentSector
+        if self.preview_base is None or sector is None:
+            return
+        hsv, step = self.preview_proxy()
+        mark = instrument.mark()
+        template = Htemplate(
+            *template_params_dict[sector], angle_to_alpha(self.colorCircle.angle)
+        )
+
+        out = hsv.copy()
+        rect = self.selection()
+        if rect is None:
+            harmonize(out, template)
+        else:
+            x, y, w, h = scale_rect(rect, self.level_scale(), self.preview_base.shape)
+            sx, sy = x // step, y // step
+            ex, ey = (x + w + step - 1) // step, (y + h + step - 1) // step
+            harmonize(out[sy:ey, sx:ex], template)
+
+        with stage("convert"):
+            rgb = np.asarray(Image.fromarray(out, mode="HSV").convert("RGB"))
+        # scaled back up at paint time
+        with stage("upload"):
+            self.preview_label.setGeometry(self.photo.display_rect())
+            self.preview_label.setPixmap(QPixmap.fromImage(numpy_to_qimage(rgb)))
+        self.preview_label.show()
+        self.photo.rubberBand.raise_()
+        self.report_profile("Preview", mark)
+
+    def commit_preview(self):
+        # render of the previewed template at the shown level on release
+        if self.preview_base is None or self.colorCircle.currentSector is None:
+            return
+        self.preview_timer.stop()
+        self.render_preview()
+        if self.job is not None:
+            self.job.cancel()  # the pool runs the new job after it
+        self.start_job(self.preview_base, preview=True)
+
+    def on_optimize_failed(self, message):
+        if self.end_job():
+            self.warning(message)
+
+    def on_optimize_cancelled(self):
+        self.end_job()
 
 
 class SectorButton(QPushButton):
@@ -542,7 +1095,16 @@ class MainWindow(QWidget):
 
         mainlay.setStretch(0, 3)
         mainlay.setStretch(1, 1)
-        self.setLayout(mainlay)
+
+        # stage timings of the last operation
+        self.statusBar = QStatusBar()
+        self.statusBar.setStyleSheet(f"color: {HALLOW};")
+        photo.profiled.connect(self.statusBar.showMessage)
+
+        outerlay = QVBoxLayout()
+        outerlay.addLayout(mainlay)
+        outerlay.addWidget(self.statusBar)
+        self.setLayout(outerlay)
         # wid.setMaximumSize(300, 300)
         # mainlay.addStretch(1)
         # mainlay.addWidget(wid)
@@ -564,6 +1126,7 @@ if __name__ == "__main__":
     from PyQt5.QtWidgets import QApplication
 
     app = QApplication(sys.argv)
+    instrument.enable(memory="--profile-memory" in sys.argv)
 
     window = MainWindow()
     # window.currentColorChanged.connect(lambda x: print(x.red(), x.green(), x.blue()))
@@ -0,0 +1,361 @@
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import socketserver
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import harmony
+from harmony import (
+    Template,
+    estimate_template,
+    harmonize,
+    histogram_template,
+    hue_histogram,
+    template_params,
+    template_params_dict,
+)
+from stream import harmonize_file, hsv_to_rgb, rgb_to_hsv
+
+# Long lived harmonization service, JSON lines in and out:
+#   python service.py --stdio -w 4            # requests on stdin
+#   python service.py --socket /tmp/cc.sock   # or a local unix socket / --port
+# One request per line, one reply per request (in completion order, match ids):
+#   {"id": 1, "op": "harmonize", "src": "in.jpg", "dst": "out.jpg"}
+#   {"id": 2, "op": "harmonize", "image": "<base64>", "format": "PNG"}
+#   {"id": 3, "op": "analyze", "src": "in.jpg"}
+#   {"id": 4, "op": "stats"}    {"id": 5, "op": "ping"}
+# stats: done/failed/rejected counts, p50/p95/mean latency, queue_depth, workers
+# optional: "template" (type), "alpha", "estimate" (subsample first)
+# Replies carry "ok", the result or "error", and "latency" (receipt to reply,
+# seconds) with its "queued" part. The queue is bounded: when it is full the
+# reader stops reading (backpressure on the pipe/socket), or with
+# --overflow reject the request is answered "busy" right away.
+# src/dst may be any file the service's user can access, and anyone who can
+# connect (any local user with --port) gets that access; --root limits them
+# to one directory.
+
+
+class Service:
+    def __init__(self, workers=2, queue_size=64, overflow="block", root=None):
+        self.queue = queue.Queue(queue_size)
+        self.overflow = overflow
+        self.root = None if root is None else os.path.realpath(root)
+        self.lock = threading.Lock()
+        self.latencies = []  # of the last 1000 replies
+        self.counts = dict(done=0, failed=0, rejected=0)
+        # warm: tables and imports paid once, not per request
+        harmony.distance_table()
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, line, reply):
+        # reply(dict) is called from a worker thread, once
+        received = time.perf_counter()
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            reply(dict(ok=False, error=f"Bad JSON: {e}"))
+            return
+        if not isinstance(request, dict):
+            reply(dict(ok=False, error="Request must be a JSON object"))
+            return
+        if self.overflow == "reject":
+            try:
+                self.queue.put_nowait((request, reply, received))
+            except queue.Full:
+                with self.lock:
+                    self.counts["rejected"] += 1
+                reply(dict(id=request.get("id"), ok=False, error="busy"))
+        else:
+            self.queue.put((request, reply, received))  # blocks the reader
+
+    def close(self):
+        # finish what is queued, then stop the workers
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def work(self):
+        while (item := self.queue.get()) is not None:
+            request, reply, received = item
+            started = time.perf_counter()
+            # one bad request must never take a worker down
+            try:
+                response = dict(ok=True, **self.handle(request))
+            except Exception as e:
+                response = dict(ok=False, error=f"{type(e).__name__}: {e}")
+            try:
+                done = time.perf_counter()
+                response.update(
+                    id=request.get("id"),
+                    queued=started - received,
+                    latency=done - received,
+                )
+                with self.lock:
+                    self.counts["done" if response["ok"] else "failed"] += 1
+                    self.latencies = self.latencies[-999:] + [done - received]
+            except Exception as e:
+                response = dict(ok=False, error=f"{type(e).__name__}: {e}")
+            reply(response)
+
+    def handle(self, request):
+        op = request.get("op", "harmonize")
+        if op == "ping":
+            return {}
+        if op == "stats":
+            return self.stats()
+        if op not in ("harmonize", "analyze"):
+            raise ValueError(f"Unknown op {op}")
+
+        template, params = None, template_params
+        if request.get("template") is not None:
+            params = [template_params_dict[request["template"]]]
+            if request.get("alpha") is not None:
+                template = Template(*params[0], request["alpha"])
+        estimate = request.get("estimate", False)
+
+        if "src" in request and op == "harmonize":
+            if "dst" not in request:
+                raise ValueError('harmonize with "src" needs "dst"')
+            template = harmonize_file(
+                self.path(request["src"]),
+                self.path(request["dst"]),
+                template,
+                params=params,
+                estimate=estimate,
+            )
+            return dict(template=template.name, alpha=template.alpha)
+
+        if "src" in request:
+            image = Image.open(self.path(request["src"]))
+        elif "image" in request:
+            image = Image.open(io.BytesIO(base64.b64decode(request["image"])))
+        else:
+            raise ValueError(f'{op} needs "src" or "image"')
+        hsv = rgb_to_hsv(np.asarray(image.convert("RGB")))
+        if template is None and estimate and params is template_params:
+            template, _, _ = estimate_template(hsv[..., 0], hsv[..., 1])
+        elif template is None:
+            template = histogram_template(
+                hue_histogram(hsv[..., 0], hsv[..., 1]), params
+            )
+        result = dict(template=template.name, alpha=template.alpha)
+        if op == "analyze":
+            return result
+
+        harmonize(hsv, template)
+        out = io.BytesIO()
+        Image.fromarray(hsv_to_rgb(hsv), mode="RGB").save(
+            out, format=request.get("format", "PNG")
+        )
+        result["image"] = base64.b64encode(out.getvalue()).decode()
+        return result
+
+    def path(self, path):
+        # a request's file, which must be inside root when one is set
+        if self.root is None:
+            return path
+        real = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, real]) != self.root:
+            raise PermissionError(f"{path} is outside {self.root}")
+        return real
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            counts = dict(self.counts)
+        if len(latencies):
+            counts.update(
+                p50=float(np.percentile(latencies, 50)),
+                p95=float(np.percentile(latencies, 95)),
+                mean=float(latencies.mean()),
+            )
+        return dict(counts, queue_depth=self.queue.qsize(), workers=len(self.workers))
+
+
+def serve_stdio(service, stdin=sys.stdin, stdout=sys.stdout):
+    # until EOF, replies are written whole lines at a time
+    lock = threading.Lock()
+
+    def reply(response):
+        with lock:
+            stdout.write(json.dumps(response) + "\n")
+            stdout.flush()
+
+    for line in stdin:
+        if line.strip():
+            service.submit(line, reply)
+    service.close()
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_socket(service, address):
+    # address: unix socket path or ("127.0.0.1", port), connections share the
+    # queue and the workers
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+            pending = threading.Semaphore(0)
+            count = 0
+
+            def reply(response):
+                with lock:
+                    try:
+                        self.wfile.write((json.dumps(response) + "\n").encode())
+                        self.wfile.flush()
+                    except OSError:  # client went away
+                        pass
+                pending.release()
+
+            for line in self.rfile:
+                if line.strip():
+                    count += 1
+                    service.submit(line, reply)
+            for _ in range(count):  # replies still owed on this connection
+                pending.acquire()
+
+    if isinstance(address, str):
+        try:  # a stale socket of an earlier run, never any other file
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                os.remove(address)
+        except FileNotFoundError:
+            pass
+        server_class = _UnixServer
+    else:
+        server_class = _TCPServer
+    with server_class(address, Handler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            service.close()
+
+
+class Client:
+    # JSON lines client for a running service (address) or for a private one
+    # started on a pipe (Client.spawn), requests may be pipelined
+    def __init__(self, reader, writer, process=None, sock=None):
+        self.reader, self.writer = reader, writer
+        self.process, self.sock = process, sock
+        self.next_id = 0
+
+    @classmethod
+    def spawn(cls, *args):
+        # args: extra service options, e.g. "-w", "4"
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--stdio", *args],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        return cls(process.stdout, process.stdin, process=process)
+
+    @classmethod
+    def connect(cls, address):
+        import socket
+
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        # separate files, map() reads and writes from two threads
+        reader = sock.makefile("r", encoding="utf-8")
+        writer = sock.makefile("w", encoding="utf-8")
+        return cls(reader, writer, sock=sock)
+
+    def send(self, **request):
+        # -> request id, the reply comes from receive()
+        if "id" not in request:
+            request["id"] = self.next_id
+            self.next_id += 1
+        self.writer.write(json.dumps(request) + "\n")
+        self.writer.flush()
+        return request["id"]
+
+    def receive(self):
+        line = self.reader.readline()
+        if not line:
+            raise EOFError("Service closed the connection")
+        return json.loads(line)
+
+    def call(self, **request):
+        request_id = self.send(**request)
+        while (response := self.receive())["id"] != request_id:
+            pass
+        return response
+
+    def map(self, requests):
+        # -> replies in request order, sent from a thread while reading
+        requests = [dict(r, id=f"map{i}") for i, r in enumerate(requests)]
+        sender = threading.Thread(
+            target=lambda: [self.send(**r) for r in requests], daemon=True
+        )
+        sender.start()
+        replies = {}
+        while len(replies) < len(requests):
+            response = self.receive()
+            replies[response["id"]] = response
+        sender.join()
+        return [replies[r["id"]] for r in requests]
+
+    def close(self):
+        if self.process is not None:
+            self.writer.close()
+            self.process.wait()
+        if self.sock is not None:
+            self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="harmonization service")
+    transport = parser.add_mutually_exclusive_group(required=True)
+    transport.add_argument("--stdio", action="store_true", help="JSON lines on stdin")
+    transport.add_argument("--socket", help="unix socket path")
+    transport.add_argument("--port", type=int, help="TCP port on 127.0.0.1")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--queue", type=int, default=64, help="max queued requests")
+    parser.add_argument(
+        "--overflow",
+        choices=["block", "reject"],
+        default="block",
+        help="full queue: stop reading (block) or answer busy (reject)",
+    )
+    parser.add_argument("--root", help="only read and write files under this directory")
+    args = parser.parse_args(argv)
+
+    service = Service(args.workers, args.queue, args.overflow, args.root)
+    if args.stdio:
+        serve_stdio(service)
+    else:
+        serve_socket(service, args.socket or ("127.0.0.1", args.port))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,386 @@
+import math
+import os
+import numpy as np
+from PIL import Image, ImageSequence
+
+from instrument import stage, timed
+
+from harmony import (
+    Template,
+    estimate_template,
+    harmonize,
+    histogram_template,
+    hue_histogram,
+    score_curves,
+    template_params,
+)
+
+# Two pass tiled harmonization for images too large to hold in HSV at once.
+# Pass 1 accumulates the hue histogram strip by strip, pass 2 remaps each strip
+# and writes it out. Memory follows tile_pixels, not the image size, as long as
+# the formats allow partial reads/writes:
+#   .npy (RGB uint8) and binary .ppm are memory mapped / streamed,
+#   anything else goes through PIL, which decodes (or assembles) the full frame.
+
+TILE_PIXELS = 1 << 22
+ALPHA_FORMATS = {"PNG", "WEBP", "TIFF", "TGA", "GIF"}  # store RGBA (GIF: on/off)
+
+
+@timed("convert")
+def rgb_to_hsv(rgb):
+    return np.array(Image.fromarray(rgb, mode="RGB").convert("HSV"))
+
+
+@timed("convert")
+def hsv_to_rgb(hsv):
+    return np.asarray(Image.fromarray(hsv, mode="HSV").convert("RGB"))
+
+
+def _read_ppm_header(f):
+    # P6 header: magic, width, height, maxval, separated by whitespace/comments
+    fields = []
+    while len(fields) < 4:
+        line = f.readline()
+        if not line:
+            raise ValueError("Truncated PPM header")
+        fields += line.split(b"#")[0].split()
+    if fields[0] != b"P6" or int(fields[3]) != 255:
+        raise ValueError("Only 8-bit binary PPM (P6) can be memory mapped")
+    return int(fields[1]), int(fields[2]), f.tell()
+
+
+class TileSource:
+    # RGB uint8 strips of a file
+    def __init__(self, path):
+        self.path = path
+        self.image = None
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".npy":
+            self.array = np.load(path, mmap_mode="r")
+        elif ext in (".ppm", ".pnm"):
+            with open(path, "rb") as f:
+                width, height, offset = _read_ppm_header(f)
+            self.array = np.memmap(
+                path, np.uint8, "r", offset=offset, shape=(height, width, 3)
+            )
+        else:
+            self.array = None
+            self.image = Image.open(path)
+
+        if self.array is not None and (
+            self.array.ndim != 3 or self.array.shape[2] != 3
+        ):
+            raise ValueError(f"{path}: expected an (h, w, 3) RGB array")
+
+    @property
+    def size(self):  # (width, height) like PIL
+        if self.array is not None:
+            return self.array.shape[1], self.array.shape[0]
+        return self.image.size
+
+    @property
+    def has_alpha(self):
+        # arrays are RGB only
+        return self.image is not None and (
+            "A" in self.image.getbands() or "transparency" in self.image.info
+        )
+
+    def strips(self, tile_pixels=TILE_PIXELS, alpha=False):
+        # alpha: yield (y, rgb, alpha plane or None) instead of (y, rgb)
+        width, height = self.size
+        rows = max(1, tile_pixels // width)
+        with_alpha = alpha and self.has_alpha
+        for y in range(0, height, rows):
+            y1 = min(height, y + rows)
+            a = None
+            with stage("read"):
+                if self.array is not None:
+                    rgb = np.asarray(self.array[y:y1])
+                elif with_alpha:
+                    rgba = np.asarray(
+                        self.image.crop((0, y, width, y1)).convert("RGBA")
+                    )
+                    rgb, a = np.ascontiguousarray(rgba[..., :3]), rgba[..., 3]
+                else:
+                    rgb = np.asarray(self.image.crop((0, y, width, y1)).convert("RGB"))
+            yield (y, rgb, a) if alpha else (y, rgb)
+
+
+class TileSink:
+    # writes RGB strips in order, use as a context manager
+    # the file is written under a temporary name and moved in place on success
+    # alpha: strips come with an alpha plane, only for ALPHA_FORMATS
+    def __init__(self, path, size, alpha=False):
+        self.path = path
+        self.size = size
+        width, height = size
+        root, ext = os.path.splitext(path)
+        self.tmp_path = root + ".part" + ext
+        self.file = self.array = self.image = None
+        self.format = Image.registered_extensions().get(ext.lower())
+        if alpha and self.format not in ALPHA_FORMATS:
+            raise ValueError(f"{path}: {ext} cannot store the alpha channel")
+        if ext.lower() == ".npy":
+            self.array = np.lib.format.open_memmap(
+                self.tmp_path, mode="w+", dtype=np.uint8, shape=(height, width, 3)
+            )
+        elif ext.lower() in (".ppm", ".pnm"):
+            self.file = open(self.tmp_path, "wb")
+            self.file.write(b"P6\n%d %d\n255\n" % (width, height))
+        else:
+            if self.format is None:
+                raise ValueError(f"{path}: unknown image format")
+            self.image = Image.new("RGBA" if alpha else "RGB", size)
+
+    @timed("save")
+    def write(self, y, rgb, alpha=None):
+        if self.array is not None:
+            self.array[y : y + len(rgb)] = rgb
+        elif self.file is not None:
+            self.file.write(np.ascontiguousarray(rgb).tobytes())
+        elif alpha is not None:
+            rgba = np.dstack([rgb, alpha])
+            self.image.paste(Image.fromarray(rgba, mode="RGBA"), (0, y))
+        else:
+            self.image.paste(Image.fromarray(rgb, mode="RGB"), (0, y))
+
+    @timed("save")
+    def close(self, keep=True):
+        if self.array is not None:
+            self.array.flush()
+            del self.array
+        elif self.file is not None:
+            self.file.close()
+        elif self.image is not None and keep:
+            self.image.save(self.tmp_path, format=self.format)
+        self.file = self.array = self.image = None
+
+        if not keep:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+        elif os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(keep=exc_type is None)
+
+
+def tiled_histogram(source: TileSource, tile_pixels=TILE_PIXELS, bins=256):
+    hue_weights = np.zeros(bins)
+    for _, rgb in source.strips(tile_pixels):
+        hsv = rgb_to_hsv(rgb)
+        hue_weights += hue_histogram(hsv[..., 0], hsv[..., 1], bins=bins)
+    return hue_weights
+
+
+def estimate_source_template(source: TileSource, max_pixels=1 << 20, min_z=3.0):
+    # -> (Template, gap, z) from a reduced image: JPEG draft decode for PIL files,
+    # strided reads of mapped arrays, then estimate_template on that
+    width, height = source.size
+    step = max(1, int(np.ceil(np.sqrt(width * height / max_pixels))))
+    if source.array is not None:
+        rgb = np.ascontiguousarray(source.array[step // 2 :: step, step // 2 :: step])
+    else:
+        image = Image.open(source.path)  # separate handle, draft changes decoding
+        image.draft("RGB", (width // step, height // step))
+        factor = max(1, image.size[0] // max(1, width // step))
+        if factor > 1:
+            image = image.reduce(factor)
+        rgb = np.asarray(image.convert("RGB"))
+    hsv = rgb_to_hsv(rgb)
+    return estimate_template(hsv[..., 0], hsv[..., 1], step=4, min_z=min_z)
+
+
+def harmonize_file(
+    src_path,
+    dst_path,
+    template: Template = None,
+    tile_pixels=TILE_PIXELS,
+    params=template_params,
+    estimate=False,
+    min_z=3.0,
+) -> Template:
+    # template None: search params on the image's histogram
+    # estimate: try a subsample first, full histogram only when it is ambiguous
+    source = src_path if isinstance(src_path, TileSource) else TileSource(src_path)
+    if template is None and estimate and params is template_params:
+        template, _, z = estimate_source_template(source, min_z=min_z)
+        if z < min_z:
+            template = None
+    if template is None:
+        hue_weights = tiled_histogram(source, tile_pixels)
+        template = histogram_template(hue_weights, params)
+
+    # alpha passes through unchanged, an output that cannot keep it fails
+    with TileSink(dst_path, source.size, alpha=source.has_alpha) as sink:
+        for y, rgb, alpha in source.strips(tile_pixels, alpha=True):
+            hsv = rgb_to_hsv(rgb)
+            harmonize(hsv, template)
+            sink.write(y, hsv_to_rgb(hsv), alpha)
+    return template
+
+
+# Frame streaming for animated files (GIF, APNG, WebP, multi-page TIFF) and
+# image sequences. Frames are decoded one at a time and remapped with one
+# template for the clip, or with per frame templates picked from score curves
+# smoothed across frames, so the rotation does not jump and flicker.
+
+
+def is_animated(path):
+    try:
+        with Image.open(path) as image:
+            return getattr(image, "n_frames", 1) > 1
+    except (OSError, ValueError):
+        return False
+
+
+class FrameSource:
+    # frames of one animated file or of a list of still images, in order
+    # every iteration decodes again, only the current frame is held
+    def __init__(self, paths):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.info = {}
+        if len(self.paths) == 1:
+            with Image.open(self.paths[0]) as image:
+                self.n_frames = getattr(image, "n_frames", 1)
+                self.size = image.size
+                self.info = {k: image.info[k] for k in ("loop",) if k in image.info}
+        else:
+            self.n_frames = len(self.paths)
+            with Image.open(self.paths[0]) as image:
+                self.size = image.size
+
+    def __len__(self):
+        return self.n_frames
+
+    def frames(self):
+        # -> (RGB uint8, duration in ms or None) per frame
+        if len(self.paths) == 1:
+            with Image.open(self.paths[0]) as image:
+                for frame in ImageSequence.Iterator(image):
+                    with stage("read"):
+                        rgb = np.asarray(frame.convert("RGB"))
+                    yield rgb, frame.info.get("duration")
+            return
+        for path in self.paths:
+            with stage("read"), Image.open(path) as image:
+                rgb = np.asarray(image.convert("RGB"))
+            yield rgb, None
+
+
+class FrameSink:
+    # a list of paths, or a pattern with a %d field, gets one still per frame
+    # as it comes; any other path is one animated file, saved on close because
+    # PIL's writers take every frame at once (GIF frames are kept palettized,
+    # 1 byte per pixel, other formats as RGB)
+    def __init__(self, path, info=None):
+        self.info = info or {}
+        self.count = 0
+        self.frames = self.durations = None
+        if isinstance(path, str) and "%" not in path:
+            root, ext = os.path.splitext(path)
+            self.format = Image.registered_extensions().get(ext.lower())
+            if self.format is None:
+                raise ValueError(f"{path}: unknown image format")
+            self.path, self.tmp_path = path, root + ".part" + ext
+            self.frames, self.durations = [], []
+        else:
+            self.path = path
+
+    def frame_path(self, index):
+        if isinstance(self.path, str):
+            return self.path % index
+        return self.path[index]
+
+    @timed("save")
+    def write(self, rgb, duration=None):
+        image = Image.fromarray(rgb, mode="RGB")
+        if self.frames is None:
+            image.save(self.frame_path(self.count))
+        else:
+            if self.format == "GIF":
+                image = image.quantize(256, method=Image.Quantize.FASTOCTREE)
+            self.frames.append(image)
+            self.durations.append(duration or 100)
+        self.count += 1
+
+    @timed("save")
+    def close(self, keep=True):
+        frames, self.frames = self.frames, None
+        if frames is None or not keep or not frames:
+            return
+        frames[0].save(
+            self.tmp_path,
+            format=self.format,
+            save_all=True,
+            append_images=frames[1:],
+            duration=self.durations,
+            loop=self.info.get("loop", 0),
+        )
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(keep=exc_type is None)
+
+
+def _frame_sample(rgb, max_pixels):
+    step = max(1, math.ceil(math.sqrt(rgb.shape[0] * rgb.shape[1] / max_pixels)))
+    hsv = rgb_to_hsv(np.ascontiguousarray(rgb[step // 2 :: step, step // 2 :: step]))
+    return hsv[..., 0], hsv[..., 1]
+
+
+def clip_histogram(source: FrameSource, max_pixels=1 << 18):
+    # summed histogram of every frame's strided sample
+    hue_weights = np.zeros(256)
+    for rgb, _ in source.frames():
+        hue_weights += hue_histogram(*_frame_sample(rgb, max_pixels))
+    return hue_weights
+
+
+def clip_template(source: FrameSource, params=template_params, max_pixels=1 << 18):
+    # one template for the whole clip
+    return histogram_template(clip_histogram(source, max_pixels), params)
+
+
+def harmonize_clip(
+    src,
+    dst,
+    template: Template = None,
+    params=template_params,
+    mode="clip",
+    smoothing=0.2,
+    max_pixels=1 << 18,
+):
+    # -> template of every frame
+    # template None, mode "clip": one template from all frames (two decodes)
+    # mode "smooth": one pass, each frame's score curves (per unit weight) are
+    # blended into a running average with weight smoothing, and the frame
+    # takes the minimum of the average
+    source = src if isinstance(src, FrameSource) else FrameSource(src)
+    if mode not in ("clip", "smooth"):
+        raise ValueError(f"Unknown clip mode {mode}")
+    if template is None and mode == "clip":
+        template = clip_template(source, params, max_pixels)
+
+    templates = []
+    curves = None
+    with FrameSink(dst, source.info) as sink:
+        for rgb, duration in source.frames():
+            hsv = rgb_to_hsv(rgb)
+            frame_template = template
+            if frame_template is None:
+                hue_weights = hue_histogram(*_frame_sample(rgb, max_pixels))
+                new = score_curves(hue_weights, params) / max(hue_weights.sum(), 1e-12)
+                curves = new if curves is None else curves + smoothing * (new - curves)
+                index, alpha = np.unravel_index(np.argmin(curves), curves.shape)
+                frame_template = Template(*params[index], int(alpha))
+            harmonize(hsv, frame_template)
+            sink.write(hsv_to_rgb(hsv), duration)
+            templates.append(frame_template)
+    return templates
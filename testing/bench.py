@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from harmony import (
+    Template,
+    binary_partition,
+    coherent_partition,
+    find_best_template,
+    harmonize,
+    hue_histogram,
+    minimize_alpha,
+    shift_color,
+    template_params,
+)
+
+# Benchmarks of the harmony hot paths on reproducible synthetic images.
+#   python testing/bench.py                          # 1 and 4 MP, all distributions
+#   python testing/bench.py --sizes 1 16 100 --save baseline.json
+#   python testing/bench.py --compare baseline.json  # exit 1 on regressions
+
+
+def synthetic_hsv(megapixels, dist, seed=0):
+    # (h, w, 3) uint8 HSV with a 3:2 aspect, same pixels for the same arguments
+    rng = np.random.default_rng(seed)
+    width = int(np.sqrt(megapixels * 1e6 * 3 / 2))
+    height = int(megapixels * 1e6 / width)
+    shape = (height, width)
+    if dist == "uniform":
+        hue = rng.integers(0, 256, shape, dtype=np.uint8)
+    elif dist == "narrow":  # one cluster
+        hue = (rng.normal(40, 8, shape) % 256).astype(np.uint8)
+    elif dist == "bimodal":  # two clusters, left/right halves
+        centers = np.where(np.arange(width) < width // 2, 60, 190)
+        hue = ((centers + rng.normal(0, 10, shape)) % 256).astype(np.uint8)
+    elif dist == "muted":  # mostly grey, a few saturated pixels
+        hue = rng.integers(0, 256, shape, dtype=np.uint8)
+    else:
+        raise ValueError(f"Unknown distribution {dist}")
+    if dist == "muted":
+        sat = (rng.exponential(12, shape).clip(0, 255)).astype(np.uint8)
+    else:
+        sat = rng.integers(64, 256, shape, dtype=np.uint8)
+    val = rng.integers(32, 256, shape, dtype=np.uint8)
+    return np.dstack([hue, sat, val])
+
+
+DISTRIBUTIONS = ["uniform", "narrow", "bimodal", "muted"]
+
+
+def cases(hsv, rgb, template):
+    # name -> zero argument callable, each works on its own copy if it writes
+    h, s = hsv[..., 0], hsv[..., 1]
+    hue_weights = hue_histogram(h, s)
+    partition = binary_partition(h, template)
+    return {
+        "hue_histogram": lambda: hue_histogram(h, s),
+        "find_best_template": lambda: find_best_template(h, s),
+        "minimize_alpha": lambda: [
+            minimize_alpha(hue_weights, param) for param in template_params
+        ],
+        "refine_alpha": lambda: minimize_alpha(
+            hue_weights, template_params[2], refine=True
+        ),
+        "binary_partition": lambda: binary_partition(h, template),
+        "coherent_partition": lambda: coherent_partition(h, template, s),
+        "shift_color": lambda: shift_color(h, partition, template),
+        "rgb_to_hsv": lambda: Image.fromarray(rgb, mode="RGB").convert("HSV"),
+        "hsv_to_rgb": lambda: Image.fromarray(hsv, mode="HSV").convert("RGB"),
+        "harmonize": lambda: harmonize(hsv, template, out=np.empty_like(hsv)),
+        "end_to_end": lambda: end_to_end(rgb),
+    }
+
+
+def end_to_end(rgb):
+    hsv = np.array(Image.fromarray(rgb, mode="RGB").convert("HSV"))
+    template = find_best_template(hsv[..., 0], hsv[..., 1])
+    harmonize(hsv, template)
+    return Image.fromarray(hsv, mode="HSV").convert("RGB")
+
+
+def measure(fn, repeat):
+    # best wall time of repeat runs, then one traced run for the peak
+    # tracemalloc sees Python/NumPy allocations, not PIL's own image memory
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def run(sizes, dists, only, repeat):
+    results = []
+    template = Template(*template_params[2], 40)  # L, two sectors
+    for megapixels in sizes:
+        for dist in dists:
+            hsv = synthetic_hsv(megapixels, dist)
+            rgb = np.asarray(Image.fromarray(hsv, mode="HSV").convert("RGB"))
+            pixels = hsv.shape[0] * hsv.shape[1]
+            for name, fn in cases(hsv, rgb, template).items():
+                if only and name not in only:
+                    continue
+                seconds, peak = measure(fn, repeat)
+                results.append(
+                    dict(
+                        name=name,
+                        megapixels=megapixels,
+                        dist=dist,
+                        seconds=seconds,
+                        mp_per_s=pixels / 1e6 / seconds if seconds > 0 else None,
+                        peak_mb=peak / 2**20,
+                    )
+                )
+                r = results[-1]
+                print(
+                    f"{name:20s} {megapixels:6g} MP {dist:8s}"
+                    f" {seconds * 1000:10.2f} ms {r['mp_per_s'] or 0:10.1f} MP/s"
+                    f" {r['peak_mb']:9.1f} MB"
+                )
+            del hsv, rgb
+    return results
+
+
+def key(r):
+    return (r["name"], r["megapixels"], r["dist"])
+
+
+def compare(results, baseline, tolerance):
+    # -> regressions: slower or bigger than the baseline by more than tolerance
+    base = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        for field in ("seconds", "peak_mb"):
+            # tiny values are noise
+            floor = 1e-3 if field == "seconds" else 1.0
+            if r[field] > max(b[field], floor) * (1 + tolerance):
+                regressions.append((r, b, field))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="harmony benchmarks")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--dists", nargs="+", default=DISTRIBUTIONS, choices=DISTRIBUTIONS
+    )
+    parser.add_argument("--only", nargs="+", help="benchmark names to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%"
+    )
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.dists, args.only, args.repeat)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    numpy=np.__version__,
+                    machine=platform.machine(),
+                    results=results,
+                ),
+                f,
+                indent=1,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r, b, field in regressions:
+            print(
+                f"REGRESSION {r['name']} {r['megapixels']:g} MP {r['dist']}:"
+                f" {field} {b[field]:.4g} -> {r[field]:.4g}"
+            )
+        if regressions:
+            return 1
+        print("no regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
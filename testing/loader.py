@@ -1,7 +1,7 @@
 from PIL import Image
 import numpy as np
 from harmony import *
-import time
+import instrument
 
 from numpy import pi, radians
 
@@ -24,17 +24,13 @@ H, S, V = np.transpose(np.reshape(hsv, (-1, 3))).astype(np.int32)
 # print(H.dtype)
 # exit()
 
-# Record start time
-start_time = time.time()
+instrument.enable()
 
 best_template = find_best_template(H, S)
 
-end_time = time.time()
-elapsed_time = end_time - start_time
 print(f"Best harmonic template: {best_template.name}")
 print(f"Best alpha: {best_template.alpha}")
 print(f"centers {best_template.sectors[0].center}, {best_template.sectors[1].center}")
-print("Elapsed time:", elapsed_time, "seconds")
 
 partition = binary_partition(H, best_template)
 # print(len(partition), np.unique(partition))
@@ -57,3 +53,5 @@ harmonized_image = Image.fromarray(new_hsv.astype(np.uint8), mode="HSV").convert
 # cannot write mode HSV as PNG
 
 harmonized_image.save("harmonized_image.png")
+
+print(instrument.format_summary(instrument.summary()))
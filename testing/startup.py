@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Import time budget of the entry modules, each in a fresh interpreter.
+#   python testing/startup.py            # exit 1 if over budget
+#   python testing/startup.py --scale 2  # slower machine, twice the budgets
+# Times exclude numpy, which everything needs anyway.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module -> (budget in ms on top of numpy, modules it must not load)
+BUDGETS = {
+    "harmony": (20, ["scipy", "tqdm", "PIL", "PyQt5"]),
+    "cli": (30, ["scipy", "tqdm", "PIL", "PyQt5"]),
+    "stream": (80, ["scipy", "tqdm", "PyQt5"]),
+    "qt": (400, ["scipy", "tqdm"]),
+}
+
+PROBE = """
+import json, sys, time
+import numpy
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps(dict(seconds=seconds, modules=sorted(sys.modules))))
+"""
+
+
+def probe(module):
+    # -> (seconds, loaded module names) of one cold import
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(out.splitlines()[-1])
+    return result["seconds"], result["modules"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="import time budgets")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--scale", type=float, default=1.0, help="budget factor")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        budget, forbidden = BUDGETS[module]
+        runs = [probe(module) for _ in range(args.repeat)]
+        seconds = min(s for s, _ in runs)
+        loaded = {name.split(".")[0] for name in runs[0][1]}
+        heavy = sorted(loaded & set(forbidden))
+        over = seconds * 1000 > budget * args.scale
+        failed |= over or bool(heavy)
+        print(
+            f"{module:10s} {seconds * 1000:8.1f} ms  budget {budget * args.scale:6.0f} ms"
+            f"{'  OVER' if over else ''}"
+            f"{'  loads ' + ', '.join(heavy) if heavy else ''}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())